@@ -0,0 +1,506 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Offline benchmark of ergae.  It runs ergae against the App Engine testbed
+stubs and a fake Dropbox server that serves urlfetch calls in-process,
+so it needs neither network nor a deployed app.  The Google App Engine SDK
+and the dependencies in :file:`requirements.txt` have to be importable:
+
+.. code-block:: console
+
+   $ python benchmark.py --feeds 50 --entries 100
+
+It generates a synthetic repository, and then measures:
+
+``pull``
+   :func:`ergae.repository.pull_from_dropbox()` and its tasks
+``repository``
+   :class:`ergae.repository.DataStoreRepository` reads, lists, exists
+   and writes
+``reader``
+   the ``subscriptions``, ``feed`` and ``entry`` views
+``push``
+   :func:`ergae.repository.push_to_dropbox()` tasks of the changes made by
+   the phases above
+
+For each phase it reports ops/sec, RPC counts by service and the peak
+resident memory during the phase (or of the whole process so far, where
+the peak can't be reset).
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import collections
+import datetime
+import email.utils
+import json
+import os
+import pickle
+import random
+import re
+import resource
+import shutil
+import tempfile
+import time
+import urllib
+import urlparse
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import urlfetch_service_pb
+from google.appengine.api.urlfetch_stub import URLFetchServiceStub
+from google.appengine.datastore.datastore_stub_util import \
+    PseudoRandomHRConsistencyPolicy
+from google.appengine.ext import deferred, testbed
+from libearth.feed import Content, Entry, Feed, Link, Person, Text
+from libearth.repository import FileSystemRepository
+from libearth.session import Session
+from libearth.stage import Stage
+from libearth.subscribe import SubscriptionList
+from libearth.tz import utc
+
+__all__ = ('DROPBOX_PATH', 'FakeDropbox', 'FakeDropboxStub', 'Phase',
+           'generate_repository', 'main', 'run_tasks')
+
+
+#: (:class:`str`) The dropbox path of the repository to sync.
+DROPBOX_PATH = '/earthreader/'
+
+#: (:class:`str`) The session id of the client that made the repository.
+SOURCE_SESSION_ID = 'benchmark'
+
+#: (:class:`numbers.Integral`) The number of entries in a delta page.
+DELTA_PAGE_SIZE = 1000
+
+
+class FakeDropbox(object):
+    """In-memory Dropbox that serves the core API calls ergae makes:
+    ``/delta``, ``/files`` and ``/files_put``.
+
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.changes = []
+        self.revision = 0
+        self.uploads = 0
+
+    def put(self, path, content):
+        path = path.lower()
+        parent = path.rsplit('/', 1)[0]
+        while parent and parent not in self.files:
+            self.files[parent] = None
+            self.changes.append(parent)
+            parent = parent.rsplit('/', 1)[0]
+        self.revision += 1
+        self.files[path] = (content, '{0:x}'.format(self.revision),
+                            datetime.datetime.utcnow())
+        self.changes.append(path)
+        return self.get_metadata(path)
+
+    def get_metadata(self, path):
+        if path not in self.files:
+            return
+        file_ = self.files[path]
+        if file_ is None:
+            return {'path': path, 'is_dir': True, 'bytes': 0, 'rev': '0',
+                    'modified': email.utils.formatdate(usegmt=True)}
+        content, rev, modified = file_
+        timestamp = time.mktime(modified.timetuple())
+        return {
+            'path': path,
+            'is_dir': False,
+            'bytes': len(content),
+            'rev': rev,
+            'modified': email.utils.formatdate(timestamp, usegmt=True)
+        }
+
+    def delta(self, cursor, path_prefix):
+        start = int(cursor or 0)
+        end = min(len(self.changes), start + DELTA_PAGE_SIZE)
+        paths = [path for path in self.changes[start:end]
+                 if path.startswith(path_prefix.lower())]
+        return {
+            'entries': [[path, self.get_metadata(path)] for path in paths],
+            'cursor': str(end),
+            'has_more': end < len(self.changes),
+            'reset': not cursor
+        }
+
+    def handle(self, method, url, headers, body):
+        """Handle the request, and then return the status code, headers
+        and the body of the response.
+
+        """
+        parsed = urlparse.urlparse(url)
+        params = dict(urlparse.parse_qsl(parsed.query))
+        if method == 'POST':
+            params.update(urlparse.parse_qsl(body))
+        match = re.match(r'^/1/(delta|files|files_put)(?:/auto(/.*))?$',
+                         urllib.unquote(parsed.path))
+        if not match:
+            return self.respond(404, {'error': 'not found'})
+        endpoint, path = match.groups()
+        if endpoint == 'delta':
+            return self.respond(200, self.delta(params.get('cursor'),
+                                                params.get('path_prefix', '')))
+        elif endpoint == 'files_put':
+            self.uploads += 1
+            return self.respond(200, self.put(path, body))
+        file_ = self.files.get(path.lower())
+        if file_ is None:
+            return self.respond(404, {'error': 'not found'})
+        content = file_[0]
+        metadata = json.dumps(self.get_metadata(path.lower()))
+        range_ = headers.get('Range')
+        if range_:
+            start, end = map(int, re.match(r'bytes=(\d+)-(\d+)',
+                                           range_).groups())
+            return 206, {'x-dropbox-metadata': metadata}, \
+                content[start:end + 1]
+        return 200, {'x-dropbox-metadata': metadata}, content
+
+    def respond(self, status, data):
+        return status, {'Content-Type': 'application/json'}, json.dumps(data)
+
+
+class FakeDropboxStub(URLFetchServiceStub):
+    """The urlfetch stub that routes every request to the :class:`FakeDropbox`.
+    Since ergae's :class:`~ergae.rest.RestClient` makes requests through
+    urlfetch, the whole client stack including async RPCs runs as it is.
+
+    """
+
+    METHODS = {
+        urlfetch_service_pb.URLFetchRequest.GET: 'GET',
+        urlfetch_service_pb.URLFetchRequest.POST: 'POST',
+        urlfetch_service_pb.URLFetchRequest.HEAD: 'HEAD',
+        urlfetch_service_pb.URLFetchRequest.PUT: 'PUT',
+        urlfetch_service_pb.URLFetchRequest.DELETE: 'DELETE'
+    }
+
+    def __init__(self, dropbox):
+        super(FakeDropboxStub, self).__init__()
+        self.dropbox = dropbox
+
+    def _Dynamic_Fetch(self, request, response):
+        headers = dict((header.key(), header.value())
+                       for header in request.header_list())
+        status, response_headers, content = self.dropbox.handle(
+            self.METHODS[request.method()], request.url(),
+            headers, request.payload()
+        )
+        response.set_statuscode(status)
+        response.set_content(content)
+        for key, value in response_headers.items():
+            header = response.add_header()
+            header.set_key(key)
+            header.set_value(value)
+
+
+def generate_repository(dropbox, feeds, entries, entry_bytes, seed=None):
+    """Generate a synthetic Earth Reader repository into the ``dropbox``,
+    as if a desktop client synchronized it.
+
+    :param dropbox: the fake dropbox to store the repository
+    :type dropbox: :class:`FakeDropbox`
+    :param feeds: the number of feeds
+    :type feeds: :class:`numbers.Integral`
+    :param entries: the number of entries per feed
+    :type entries: :class:`numbers.Integral`
+    :param entry_bytes: the approximate size of the content of each entry
+    :type entry_bytes: :class:`numbers.Integral`
+    :param seed: the random seed
+    :returns: the mapping of feed ids to their entries
+    :rtype: :class:`collections.Mapping`
+
+    """
+    rand = random.Random(seed)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+             'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor']
+    path = tempfile.mkdtemp(prefix='ergae-benchmark-')
+    now = datetime.datetime.now(utc)
+    generated = collections.OrderedDict()
+    try:
+        stage = Stage(Session(SOURCE_SESSION_ID), FileSystemRepository(path))
+        subscriptions = SubscriptionList()
+        subscriptions.title = 'Benchmark'
+        subscriptions.owner = Person(name='Benchmark',
+                                     email='benchmark@example.com')
+        with stage:
+            for i in xrange(feeds):
+                uri = 'http://feed{0}.example.com/'.format(i)
+                feed = Feed(id=uri + 'atom.xml',
+                            title=Text(value='Feed #{0}'.format(i)),
+                            updated_at=now,
+                            links=[Link(relation='alternate', uri=uri,
+                                        mimetype='text/html')])
+                feed_entries = []
+                for j in xrange(entries):
+                    text = ' '.join(rand.choice(words) for _ in
+                                    xrange(max(entry_bytes // 6, 1)))
+                    updated_at = now - datetime.timedelta(hours=j)
+                    entry_uri = '{0}{1}/'.format(uri, j)
+                    feed_entries.append(Entry(
+                        id=entry_uri,
+                        title=Text(value='Entry #{0}-{1}'.format(i, j)),
+                        updated_at=updated_at,
+                        published_at=updated_at,
+                        authors=[Person(name='Author #{0}'.format(i))],
+                        links=[Link(relation='alternate', uri=entry_uri,
+                                    mimetype='text/html')],
+                        content=Content(type='html',
+                                        value=u'<p>{0}</p>'.format(text))
+                    ))
+                feed.entries = feed_entries
+                subscription = subscriptions.subscribe(feed)
+                stage.feeds[subscription.feed_id] = feed
+                generated[subscription.feed_id] = feed_entries
+            stage.subscriptions = subscriptions
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                key = os.path.relpath(filepath, path).replace(os.sep, '/')
+                with open(filepath, 'rb') as f:
+                    dropbox.put(DROPBOX_PATH + key, f.read())
+    finally:
+        shutil.rmtree(path)
+    return generated
+
+
+def start_request():
+    """Make the following calls belong to a new request, as request-local
+    caches rely on the request log id.
+
+    """
+    os.environ['REQUEST_LOG_ID'] = os.urandom(16).encode('hex')
+
+
+def run_tasks(taskqueue_stub, predicate=None):
+    """Run queued deferred tasks including tasks they queue until the queue
+    gets empty, ignoring their countdowns.
+
+    :param predicate: an optional function that takes a deferred function
+                      and returns whether to run it.  tasks of other
+                      functions are left in the queue
+    :type predicate: :class:`collections.Callable`
+    :returns: the number of run tasks
+    :rtype: :class:`numbers.Integral`
+
+    """
+    count = 0
+    while 1:
+        tasks = taskqueue_stub.get_filtered_tasks(queue_names=['default'])
+        if predicate is not None:
+            tasks = [task for task in tasks
+                     if predicate(pickle.loads(task.payload)[0])]
+        if not tasks:
+            return count
+        for task in tasks:
+            taskqueue_stub.DeleteTask('default', task.name)
+            start_request()
+            deferred.run(task.payload)
+            count += 1
+
+
+def reset_peak_memory():
+    """Reset the peak resident set size of the process, so that
+    :func:`get_peak_memory()` reports the peak since then.  It works only
+    on Linux 4.0 or higher.
+
+    :returns: whether it was reset
+    :rtype: :class:`bool`
+
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def get_peak_memory():
+    """Get the peak resident set size of the process in kilobytes."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Phase(object):
+    """Measure the elapsed time, RPC counts by service and the peak memory
+    of a benchmark phase.  If the peak memory can't be reset per phase
+    (see :func:`reset_peak_memory()`), the peak of the whole process so far
+    is reported instead, and labeled so.
+
+    :param name: the phase name
+    :type name: :class:`str`
+
+    """
+
+    #: (:class:`collections.Counter`) RPC counts of the current phase
+    #: by service.  :func:`count_rpc()` counts into it.
+    rpcs = None
+
+    def __init__(self, name):
+        self.name = name
+        self.ops = 0
+
+    def __enter__(self):
+        Phase.rpcs = self.rpcs = collections.Counter()
+        self.peak_reset = reset_peak_memory()
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self.started_at
+        self.peak_memory = get_peak_memory()
+        Phase.rpcs = None
+        if exc_type is None:
+            self.report()
+
+    def report(self):
+        print('{0:<12} {1:>7} ops {2:>9.3f} s {3:>10.1f} ops/s '
+              '{4:>7} rpcs {5:>8.1f} MB peak ({6})'.format(
+                  self.name, self.ops, self.elapsed,
+                  self.ops / self.elapsed if self.elapsed else 0,
+                  sum(self.rpcs.values()), self.peak_memory / 1024.0,
+                  'phase' if self.peak_reset else 'process'
+              ))
+        for service, count in sorted(self.rpcs.items()):
+            print('    {0:<24} {1:>7}'.format(service, count))
+
+
+def count_rpc(service, call, request, response):
+    if Phase.rpcs is not None:
+        Phase.rpcs[service] += 1
+
+
+def setup_testbed(dropbox):
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='ergae-benchmark', overwrite=True)
+    policy = PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_blobstore_stub()
+    bed.init_files_stub()
+    bed.init_app_identity_stub()
+    bed.init_user_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(__file__) or '.')
+    apiproxy_stub_map.apiproxy.RegisterStub('urlfetch',
+                                            FakeDropboxStub(dropbox))
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark',
+                                                        count_rpc)
+    return bed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--feeds', type=int, default=20,
+                        help='the number of feeds [%(default)s]')
+    parser.add_argument('--entries', type=int, default=50,
+                        help='the number of entries per feed [%(default)s]')
+    parser.add_argument('--entry-bytes', type=int, default=2000,
+                        help='the size of each entry [%(default)s]')
+    parser.add_argument('--operations', type=int, default=200,
+                        help='the number of repository operations and '
+                             'reader requests [%(default)s]')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the random seed [%(default)s]')
+    args = parser.parse_args()
+    rand = random.Random(args.seed)
+    dropbox = FakeDropbox()
+    bed = setup_testbed(dropbox)
+    try:
+        # ergae has to be imported after the stubs are set up, since
+        # it reads configs and installs hooks on import.
+        start_request()
+        from ergae.app import app
+        from ergae.config import set_config
+        from ergae.index import get_entry_key
+        from ergae.repository import (DataStoreRepository, pull_from_dropbox,
+                                      push_to_dropbox, put_slot)
+        taskqueue_stub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        generated = generate_repository(dropbox, args.feeds, args.entries,
+                                        args.entry_bytes, args.seed)
+        print('{0} files, {1} bytes in the repository'.format(
+            sum(1 for f in dropbox.files.values() if f is not None),
+            sum(len(f[0]) for f in dropbox.files.values() if f is not None)
+        ))
+        start_request()
+        for key, value in [('dropbox_app_key', 'key'),
+                           ('dropbox_app_secret', 'secret'),
+                           ('dropbox_access_token', 'token'),
+                           ('dropbox_user_id', 'user'),
+                           ('dropbox_path', DROPBOX_PATH)]:
+            set_config(key, value)
+
+        with Phase('pull') as phase:
+            start_request()
+            pull_from_dropbox()
+            run_tasks(taskqueue_stub)
+            phase.ops = sum(1 for f in dropbox.files.values()
+                            if f is not None)
+
+        feed_ids = list(generated)
+        repository = DataStoreRepository()
+        with Phase('repository') as phase:
+            for _ in xrange(args.operations):
+                start_request()
+                feed_id = rand.choice(feed_ids)
+                feed_key = ['feeds', feed_id]
+                names = repository.list(feed_key)
+                key = feed_key + [sorted(names)[0]]
+                repository.exists(key)
+                content = ''.join(repository.read(key))
+                repository.write(feed_key + ['benchmark-copy.xml'],
+                                 [content])
+                phase.ops += 4
+
+        client = app.test_client()
+        with Phase('reader') as phase:
+            for _ in xrange(args.operations):
+                feed_id = rand.choice(feed_ids)
+                entry = rand.choice(generated[feed_id])
+                for url in ['/feeds/',
+                            '/feeds/{0}/'.format(feed_id),
+                            '/feeds/{0}/entries/{1}/'.format(
+                                feed_id, get_entry_key(entry))]:
+                    start_request()
+                    response = client.get(url)
+                    assert response.status_code == 200, \
+                        '{0}: {1}'.format(url, response.status)
+                    phase.ops += 1
+
+        # Other tasks queued by the phases above (e.g. unread recounts)
+        # aren't pushes, so they are run before the push phase starts.
+        push_functions = put_slot, push_to_dropbox
+        run_tasks(taskqueue_stub, lambda f: f not in push_functions)
+        with Phase('push') as phase:
+            uploads = dropbox.uploads
+            run_tasks(taskqueue_stub, lambda f: f in push_functions)
+            phase.ops = dropbox.uploads - uploads
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,9 @@ from gae_mini_profiler.profiler import ProfilerWSGIMiddleware
 from gae_mini_profiler.templatetags import profiler_includes
 
 from .config import get_config, set_config
+from .crawler import mod as crawler
 from .dropbox import mod as dropbox
+from .metrics import flush as flush_metrics, mod as metrics
 from .reader import mod as reader
 from .util import MethodRewriteMiddleware
 
@@ -30,7 +32,9 @@ __all__ = 'app',
 
 
 app = Flask(__name__)
+app.register_blueprint(crawler)
 app.register_blueprint(dropbox)
+app.register_blueprint(metrics)
 app.register_blueprint(reader)
 
 app.secret_key = get_config('secret_key')
@@ -40,5 +44,11 @@ if app.secret_key is None:
 
 app.jinja_env.globals['profiler_includes'] = profiler_includes
 
+
+@app.teardown_request
+def flush_request_metrics(exception=None):
+    flush_metrics()
+
+
 app.wsgi_app = MethodRewriteMiddleware(app.wsgi_app)
 app.wsgi_app = ProfilerWSGIMiddleware(app.wsgi_app)
@@ -0,0 +1,258 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+
+import collections
+import functools
+import os
+import sys
+import threading
+
+from google.appengine.api import memcache
+
+from .metrics import get_counter
+
+__all__ = ('LOCAL_CACHE_BYTES_LIMIT', 'LocalCache', 'add_multi', 'delete',
+           'delete_multi', 'get', 'get_boxed_multi', 'get_local_cache',
+           'get_multi', 'set', 'set_boxed', 'set_multi')
+
+
+#: (:class:`numbers.Integral`) The byte budget of the local cache
+#: of each request.
+LOCAL_CACHE_BYTES_LIMIT = 16 * 1000 * 1000  # 16MB
+
+
+class LocalCache(object):
+    """LRU cache of which total size of values is bounded.
+
+    :param bytes_limit: the byte budget of values
+    :type bytes_limit: :class:`numbers.Integral`
+
+    """
+
+    def __init__(self, bytes_limit=LOCAL_CACHE_BYTES_LIMIT):
+        self.bytes_limit = bytes_limit
+        self.size = 0
+        self.items = collections.OrderedDict()
+
+    def get(self, key, namespace=None):
+        try:
+            value, size = self.items.pop((namespace, key))
+        except KeyError:
+            return
+        self.items[namespace, key] = value, size
+        return value
+
+    def set(self, key, value, namespace=None):
+        self.delete(key, namespace)
+        size = get_size(value)
+        if size > self.bytes_limit:
+            return
+        self.items[namespace, key] = value, size
+        self.size += size
+        while self.size > self.bytes_limit:
+            _, (_, evicted_size) = self.items.popitem(last=False)
+            self.size -= evicted_size
+
+    def delete(self, key, namespace=None):
+        try:
+            _, size = self.items.pop((namespace, key))
+        except KeyError:
+            return
+        self.size -= size
+
+
+def get_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    elif isinstance(value, (collections.Set, collections.Sequence)):
+        return sum(get_size(v) for v in value) + sys.getsizeof(value)
+    return sys.getsizeof(value)
+
+
+local = threading.local()
+
+
+def get_local_cache():
+    """Get the local cache of the current request.
+
+    :returns: the local cache of the current request.  :const:`None`
+              outside of requests, where nothing tells when to drop it
+    :rtype: :class:`LocalCache`
+
+    """
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if request_id is None:
+        return
+    if getattr(local, 'request_id', None) != request_id or \
+       not hasattr(local, 'cache'):
+        local.request_id = request_id
+        local.cache = LocalCache()
+    return local.cache
+
+
+def record_access(namespace, local_hits=0, hits=0, misses=0):
+    """Count cache accesses of the ``namespace`` in
+    ``cache.<namespace>.local_hits``, ``cache.<namespace>.hits`` and
+    ``cache.<namespace>.misses`` counters (see :mod:`ergae.metrics`).
+
+    """
+    prefix = 'cache.{0}.'.format(namespace or 'default')
+    for field, count in [('local_hits', local_hits), ('hits', hits),
+                         ('misses', misses)]:
+        if count:
+            get_counter(prefix + field).increment(count)
+
+
+def get(key, namespace=None):
+    cache = get_local_cache()
+    if cache is not None:
+        value = cache.get(key, namespace)
+        if value is not None:
+            record_access(namespace, local_hits=1)
+            return value
+    value = memcache.get(key, namespace=namespace)
+    if value is None:
+        record_access(namespace, misses=1)
+    else:
+        record_access(namespace, hits=1)
+        if cache is not None:
+            cache.set(key, value, namespace)
+    return value
+
+
+def get_multi(keys, namespace=None):
+    cache = get_local_cache()
+    if cache is None:
+        result = memcache.get_multi(keys, namespace=namespace)
+        record_access(namespace, hits=len(result),
+                      misses=len(keys) - len(result))
+        return result
+    result = {}
+    missing_keys = []
+    for key in keys:
+        value = cache.get(key, namespace)
+        if value is None:
+            missing_keys.append(key)
+        else:
+            result[key] = value
+    local_hits = len(result)
+    if missing_keys:
+        fetched = memcache.get_multi(missing_keys, namespace=namespace)
+        for key, value in fetched.iteritems():
+            cache.set(key, value, namespace)
+        result.update(fetched)
+    record_access(namespace, local_hits=local_hits,
+                  hits=len(result) - local_hits,
+                  misses=len(keys) - len(result))
+    return result
+
+
+def set(key, value, namespace=None):
+    cache = get_local_cache()
+    if cache is not None:
+        cache.set(key, value, namespace)
+    return memcache.set(key, value, namespace=namespace)
+
+
+def set_multi(mapping, namespace=None):
+    cache = get_local_cache()
+    if cache is not None:
+        for key, value in mapping.iteritems():
+            cache.set(key, value, namespace)
+    return memcache.set_multi(mapping, namespace=namespace)
+
+
+def add_multi(mapping, namespace=None):
+    """Set values only of keys not cached yet, so that a value read from
+    the data store doesn't overwrite a newer value set meanwhile.
+
+    :returns: the list of keys that weren't added
+    :rtype: :class:`collections.Sequence`
+
+    """
+    not_added = memcache.add_multi(mapping, namespace=namespace)
+    cache = get_local_cache()
+    if cache is not None:
+        for key in frozenset(mapping).difference(not_added):
+            cache.set(key, mapping[key], namespace)
+    return not_added
+
+
+def delete(key, namespace=None):
+    cache = get_local_cache()
+    if cache is not None:
+        cache.delete(key, namespace)
+    return memcache.delete(key, namespace=namespace)
+
+
+def delete_multi(keys, namespace=None):
+    cache = get_local_cache()
+    if cache is not None:
+        for key in keys:
+            cache.delete(key, namespace)
+    return memcache.delete_multi(keys, namespace=namespace)
+
+
+def get_boxed_multi(keys, load, namespace=None, fresh=False):
+    """Get the values of the given ``keys`` through memcache, loading
+    missing ones by ``load()`` and then filling memcache with them.
+
+    Values are cached boxed in 1-tuples, so that :const:`None` values
+    (e.g. unset keys) are cached as ``(None,)`` and distinguished from
+    cache misses.  Loaded values are only added (see :func:`add_multi()`),
+    and if other values were set meanwhile, those newer values are
+    taken instead.
+
+    :param keys: the keys to get
+    :type keys: :class:`collections.Sequence`
+    :param load: the function that takes the missing keys and returns
+                 the mapping of them to their values
+    :type load: :class:`collections.Callable`
+    :param fresh: skip the local cache of the request, for values that
+                  other requests may have changed during the request
+    :type fresh: :class:`bool`
+    :returns: the mapping of all ``keys`` to their values
+    :rtype: :class:`collections.Mapping`
+
+    """
+    if fresh:
+        get_multi_ = functools.partial(memcache.get_multi,
+                                       namespace=namespace)
+    else:
+        get_multi_ = functools.partial(get_multi, namespace=namespace)
+    cached = get_multi_(keys)
+    result = dict((key, value[0]) for key, value in cached.iteritems())
+    missing = [key for key in keys if key not in cached]
+    if missing:
+        loaded = load(missing)
+        not_added = add_multi(
+            dict((key, (value,)) for key, value in loaded.iteritems()),
+            namespace=namespace
+        )
+        if not_added:
+            cached = get_multi_(not_added)
+            loaded.update((key, value[0]) for key, value in cached.iteritems())
+        result.update(loaded)
+    return result
+
+
+def set_boxed(key, value, namespace=None):
+    """Set the ``value`` of the ``key`` boxed in a 1-tuple.
+    See also :func:`get_boxed_multi()`.
+
+    """
+    return set(key, (value,), namespace=namespace)
@@ -15,29 +15,146 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import
 
-from google.appengine.api.memcache import delete, get, set as put
-from google.appengine.ext.ndb import Model, PickleProperty
+import os
+import threading
+import uuid
 
-__all__ = 'Config', 'get_config', 'set_config'
+from google.appengine.api.memcache import add, get, set as put
+from google.appengine.ext.ndb import Key, Model, PickleProperty, transactional
+from google.appengine.ext.ndb import get_multi as ndb_get_multi
 
+from .cache import get_boxed_multi, set_boxed
+
+__all__ = ('Config', 'get_config', 'get_configs', 'set_config',
+           'update_config')
+
+
+#: The instance-local cache of config values.  It's valid only while
+#: its version is the same as the version stamp in memcache, which is
+#: checked once per request.
+local = threading.local()
+local_cache = {'version': None, 'values': {}}
+
+
+def get_version():
+    """Get the version stamp of configs.  It's checked once per request
+    (or every time outside of requests), and the instance-local cache is
+    cleared if it's changed.
+
+    """
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if request_id is not None and \
+       getattr(local, 'request_id', None) == request_id and \
+       getattr(local, 'version', None) is not None:
+        return local.version
+    version = get('version', namespace='config_version')
+    if version is None:
+        version = uuid.uuid4().hex
+        if not add('version', version, namespace='config_version'):
+            version = get('version', namespace='config_version') or version
+    if local_cache['version'] != version:
+        local_cache['values'] = {}
+        local_cache['version'] = version
+    local.request_id = request_id
+    local.version = version
+    return version
+
+
+def bump_version():
+    version = uuid.uuid4().hex
+    put('version', version, namespace='config_version')
+    local.request_id = os.environ.get('REQUEST_LOG_ID')
+    local.version = version
+    local_cache['version'] = version
+
+
+def get_configs(keys, fresh=False):
+    """Get the config values of the given ``keys`` at once.  Values are
+    read through the instance-local cache, memcache and then the data store,
+    and keys missing in a tier are looked up in the next tier by one batch
+    call.  Unset keys are cached as well.
+
+    :param keys: the config keys to get
+    :type keys: :class:`collections.Iterable`
+    :param fresh: skip the instance-local cache, for values that other
+                  requests may have changed during the current request
+    :type fresh: :class:`bool`
+    :returns: the mapping of keys to their values (:const:`None` if unset)
+    :rtype: :class:`collections.Mapping`
+
+    """
+    keys = list(keys)
+    version = get_version()
+    values = local_cache['values']
+    if fresh:
+        result = {}
+    else:
+        result = dict((key, values[key]) for key in keys if key in values)
+    missing = [key for key in keys if key not in result]
+    if missing:
+        result.update(get_boxed_multi(missing, load_pairs,
+                                      namespace='config_values', fresh=fresh))
+    if local_cache['version'] == version:
+        values.update(result)
+    return result
 
-def get_config(key):
-    value = get(key, namespace='config')
-    if value:
-        return value
-    pair = Pair.get_by_id(key)
-    return pair and pair.value
+
+def load_pairs(keys):
+    pairs = ndb_get_multi([Key(Pair, key) for key in keys])
+    return dict((key, pair and pair.value) for key, pair in zip(keys, pairs))
+
+
+def get_config(key, fresh=False):
+    """Get the config value of the given ``key``.
+    See also :func:`get_configs()`.
+
+    :param key: the config key to get
+    :type key: :class:`basestring`
+    :param fresh: skip the instance-local cache, for values that other
+                  requests may have changed during the current request
+    :type fresh: :class:`bool`
+    :returns: the value.  :const:`None` if it's unset
+
+    """
+    return get_configs([key], fresh=fresh)[key]
+
+
+def store_config(key, value):
+    set_boxed(key, value, namespace='config_values')
+    bump_version()
+    local_cache['values'] = {key: value}
 
 
 def set_config(key, value):
     if value is None:
+        Key(Pair, key).delete()
+    else:
+        Pair(id=key, value=value).put()
+    store_config(key, value)
+
+
+def update_config(key, function):
+    """Atomically replace the value of ``key`` with ``function(value)``.
+    The ``function`` may be called more than once if the transaction
+    is retried.
+
+    :param key: the config key to update
+    :type key: :class:`basestring`
+    :param function: the function that takes the current value
+                     (:const:`None` if not set yet) and returns a new value
+    :type function: :class:`collections.Callable`
+    :returns: the updated value
+
+    """
+    @transactional
+    def txn():
         pair = Pair.get_by_id(key)
-        if pair is not None:
-            pair.delete()
-        delete(key, namespace='config')
-        return
-    put(key, value, namespace='config')
-    Pair.get_or_insert(key, value=value)
+        value = function(pair and pair.value)
+        Pair(id=key, value=value).put()
+        return value
+    value = txn()
+    store_config(key, value)
+    return value
 
 
 class Pair(Model):
@@ -0,0 +1,409 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+
+import collections
+import datetime
+import heapq
+import logging
+import random
+import time
+import urlparse
+
+from flask import Blueprint
+from google.appengine.api.apiproxy_stub_map import UserRPC
+from google.appengine.api.taskqueue import (TaskAlreadyExistsError,
+                                            TombstonedTaskError)
+from google.appengine.api.urlfetch import (Error as UrlFetchError,
+                                           create_rpc, make_fetch_call)
+from google.appengine.ext.db import (DateTimeProperty, FloatProperty,
+                                     IntegerProperty, Model, StringProperty,
+                                     put as db_put, put_async as db_put_async)
+from google.appengine.ext.deferred import defer
+from libearth.feed import Link
+from libearth.parser.autodiscovery import get_format
+
+from .index import build_entry_index, get_entry_index
+from .stage import get_stage
+
+__all__ = ('CRAWL_CONCURRENCY', 'CRAWL_LEASE', 'CRAWL_LIMIT', 'CRAWL_PERIOD',
+           'CRAWL_TIMEOUT', 'DEFAULT_CRAWL_INTERVAL', 'HOST_CONCURRENCY',
+           'MAX_BACKOFF', 'MAX_CRAWL_INTERVAL', 'MIN_CRAWL_INTERVAL',
+           'CrawlState', 'crawl_feed', 'crawl_feeds', 'fetch_feeds',
+           'get_due_feeds', 'merge_feed', 'mod')
+
+
+#: (:class:`numbers.Integral`) The number of feeds to fetch at a time.
+CRAWL_CONCURRENCY = 20
+
+#: (:class:`numbers.Integral`) The number of feeds to fetch at a time
+#: from the same host.
+HOST_CONCURRENCY = 2
+
+#: (:class:`numbers.Integral`) The maximum number of feeds to crawl
+#: at a time.  Feeds that are more overdue are crawled first.
+CRAWL_LIMIT = 200
+
+#: (:class:`numbers.Real`) Seconds to wait for the response of a feed.
+CRAWL_TIMEOUT = 30
+
+#: (:class:`numbers.Real`) Seconds between crawls of a feed that
+#: there's no statistics of yet.
+DEFAULT_CRAWL_INTERVAL = 60 * 60
+
+#: (:class:`numbers.Real`) The minimum seconds between crawls of a feed.
+MIN_CRAWL_INTERVAL = 15 * 60
+
+#: (:class:`numbers.Real`) The maximum seconds between crawls of a feed.
+MAX_CRAWL_INTERVAL = 24 * 60 * 60
+
+#: (:class:`numbers.Real`) The maximum seconds to back off from
+#: a feed that keeps failing.
+MAX_BACKOFF = 7 * 24 * 60 * 60
+
+#: (:class:`numbers.Integral`) The number of the latest entries to
+#: estimate the publish frequency of a feed.
+FREQUENCY_SAMPLE_SIZE = 10
+
+#: (:class:`numbers.Real`) Seconds that a crawl claims due feeds for.
+#: Other crawls don't pick them during the time, and if the crawl dies
+#: they become due again after it.  It's the deadline of a task.
+CRAWL_LEASE = 10 * 60
+
+#: (:class:`numbers.Real`) Seconds between crawls.  It has to be
+#: the same to the schedule in :file:`cron.yaml`.
+CRAWL_PERIOD = 10 * 60
+
+
+mod = Blueprint('crawler', __name__, url_prefix='/crawler')
+
+
+class CrawlState(Model):
+    """The state of the last crawl of a feed, for conditional requests,
+    and its statistics to schedule the next crawl.  Its key name is
+    the feed id.
+
+    """
+
+    #: (:class:`basestring`) The url of the crawled feed.
+    feed_uri = StringProperty(required=True, indexed=False)
+
+    #: (:class:`basestring`) The ``ETag`` of the last response.
+    etag = StringProperty(indexed=False)
+
+    #: (:class:`basestring`) The ``Last-Modified`` of the last response.
+    last_modified = StringProperty(indexed=False)
+
+    #: (:class:`datetime.datetime`) The time of the last crawl.
+    crawled_at = DateTimeProperty(auto_now=True)
+
+    #: (:class:`datetime.datetime`) The time when new entries were found
+    #: last time.
+    changed_at = DateTimeProperty(indexed=False)
+
+    #: (:class:`numbers.Real`) Estimated seconds between new entries.
+    interval = FloatProperty(default=float(DEFAULT_CRAWL_INTERVAL),
+                             indexed=False)
+
+    #: (:class:`numbers.Integral`) The number of consecutive failures.
+    failures = IntegerProperty(default=0, indexed=False)
+
+    #: (:class:`datetime.datetime`) The time when the feed is due to
+    #: be crawled.
+    next_crawl_at = DateTimeProperty()
+
+    def reschedule(self, now, entries=None, changed=False, failed=False):
+        """Update the statistics by the result of a crawl, and then
+        schedule the next crawl.
+
+        - If new entries are found, the interval follows the average gap
+          between the latest entries.
+        - If nothing changed, the interval grows by half.
+        - If it failed, the next crawl backs off exponentially with jitter,
+          but the interval remains.
+
+        :param now: the time of the crawl
+        :type now: :class:`datetime.datetime`
+        :param entries: the crawled entries
+        :type entries: :class:`collections.Iterable`
+        :param changed: whether there were new entries
+        :type changed: :class:`bool`
+        :param failed: whether the crawl failed
+        :type failed: :class:`bool`
+
+        """
+        if failed:
+            self.failures += 1
+            backoff = min(self.interval * 2 ** self.failures, MAX_BACKOFF)
+            delay = backoff * random.uniform(0.5, 1)
+        else:
+            self.failures = 0
+            if changed:
+                self.changed_at = now
+                times = heapq.nlargest(
+                    FREQUENCY_SAMPLE_SIZE,
+                    (entry.updated_at for entry in entries or ())
+                )
+                if len(times) > 1:
+                    span = times[0] - times[-1]
+                    self.interval = span.total_seconds() / (len(times) - 1)
+                else:
+                    self.interval /= 2
+            else:
+                self.interval *= 1.5
+            self.interval = max(MIN_CRAWL_INTERVAL,
+                                min(self.interval, MAX_CRAWL_INTERVAL))
+            delay = self.interval
+        self.next_crawl_at = now + datetime.timedelta(seconds=delay)
+
+
+def get_due_feeds(feeds, states, now, limit=CRAWL_LIMIT):
+    """Pick feeds that are due to be crawled, the most overdue first.
+    Feeds never crawled before come first of all.
+
+    :param feeds: the mapping of feed ids to feed urls
+    :type feeds: :class:`collections.Mapping`
+    :param states: the mapping of feed ids to their :class:`CrawlState`
+    :type states: :class:`collections.Mapping`
+    :param now: the current time
+    :type now: :class:`datetime.datetime`
+    :param limit: the maximum number of feeds to pick
+    :type limit: :class:`numbers.Integral`
+    :returns: pairs of feed id and feed url
+    :rtype: :class:`collections.Sequence`
+
+    """
+    queue = []
+    for feed_id, feed_uri in feeds.iteritems():
+        state = states.get(feed_id)
+        if state is None or state.feed_uri != feed_uri or \
+           state.next_crawl_at is None:
+            due_at = datetime.datetime.min
+        elif state.next_crawl_at <= now:
+            due_at = state.next_crawl_at
+        else:
+            continue
+        queue.append((due_at, feed_id, feed_uri))
+    return [(feed_id, feed_uri)
+            for _, feed_id, feed_uri in heapq.nsmallest(limit, queue)]
+
+
+def fetch_feeds(feeds, states, concurrency=CRAWL_CONCURRENCY,
+                host_concurrency=HOST_CONCURRENCY):
+    """Fetch ``feeds`` concurrently.  Requests are conditional if
+    the ``states`` of the previous crawl are given.
+
+    :param feeds: pairs of feed id and feed url
+    :type feeds: :class:`collections.Iterable`
+    :param states: the mapping of feed ids to their :class:`CrawlState`
+    :type states: :class:`collections.Mapping`
+    :param concurrency: the number of feeds to fetch at a time
+    :type concurrency: :class:`numbers.Integral`
+    :param host_concurrency: the number of feeds to fetch at a time
+                             from the same host
+    :type host_concurrency: :class:`numbers.Integral`
+    :returns: triples of feed id, feed url and the response (or
+              the :exc:`google.appengine.api.urlfetch.Error` if failed)
+              in order of completion
+    :rtype: :class:`collections.Iterable`
+
+    """
+    pending = list(feeds)
+    running = {}
+    hosts = collections.Counter()
+
+    def fetch_next():
+        waiting = []
+        for feed_id, feed_uri in pending:
+            host = urlparse.urlparse(feed_uri).netloc
+            if len(running) >= concurrency or \
+               hosts[host] >= host_concurrency:
+                waiting.append((feed_id, feed_uri))
+                continue
+            headers = {}
+            state = states.get(feed_id)
+            if state is not None and state.feed_uri == feed_uri:
+                if state.etag:
+                    headers['If-None-Match'] = state.etag
+                if state.last_modified:
+                    headers['If-Modified-Since'] = state.last_modified
+            rpc = create_rpc(deadline=CRAWL_TIMEOUT)
+            make_fetch_call(rpc, feed_uri, headers=headers)
+            running[rpc] = feed_id, feed_uri, host
+            hosts[host] += 1
+        pending[:] = waiting
+
+    fetch_next()
+    while running:
+        rpc = UserRPC.wait_any(running)
+        feed_id, feed_uri, host = running.pop(rpc)
+        hosts[host] -= 1
+        try:
+            response = rpc.get_result()
+        except UrlFetchError as e:
+            response = e
+        fetch_next()
+        yield feed_id, feed_uri, response
+
+
+def merge_feed(feed_id, feed_uri, crawled_feed):
+    """Merge only new entries of the ``crawled_feed`` into the stored feed.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :param feed_uri: the crawled url
+    :type feed_uri: :class:`basestring`
+    :param crawled_feed: the crawled feed
+    :type crawled_feed: :class:`libearth.feed.Feed`
+    :returns: the number of new entries
+    :rtype: :class:`numbers.Integral`
+
+    """
+    stage = get_stage()
+    with stage:
+        try:
+            feed = stage.feeds[feed_id]
+        except LookupError:
+            feed = crawled_feed
+            if not any(link.relation == 'self' for link in feed.links):
+                feed.links.append(Link(relation='self', uri=feed_uri))
+            entries = list(feed.entries)
+            new_count = len(entries)
+        else:
+            entry_ids = frozenset(entry.id for entry in feed.entries)
+            entries = [entry for entry in crawled_feed.entries
+                       if entry.id not in entry_ids]
+            new_count = len(entries)
+            if not new_count:
+                return 0
+            entries.extend(feed.entries)
+        feed.entries = sorted(entries,
+                              key=lambda entry: entry.updated_at,
+                              reverse=True)
+        stage.feeds[feed_id] = feed
+    build_entry_index(feed_id, feed, get_entry_index(feed_id))
+    return new_count
+
+
+def crawl_feeds(concurrency=CRAWL_CONCURRENCY, limit=CRAWL_LIMIT):
+    """Crawl subscribed feeds that are due (see :func:`get_due_feeds()`),
+    and merge their new entries.  Feeds that are not modified since
+    the last crawl are skipped.
+
+    :param concurrency: the number of feeds to fetch at a time
+    :type concurrency: :class:`numbers.Integral`
+    :param limit: the maximum number of feeds to crawl
+    :type limit: :class:`numbers.Integral`
+
+    """
+    logger = logging.getLogger(__name__ + '.crawl_feeds')
+    stage = get_stage()
+    with stage:
+        subscriptions = stage.subscriptions
+        if subscriptions is None:
+            return
+        feeds = dict((sub.feed_id, sub.feed_uri)
+                     for sub in subscriptions.recursive_subscriptions)
+    states = dict(zip(feeds, CrawlState.get_by_key_name(list(feeds))))
+    now = datetime.datetime.utcnow()
+    due_feeds = get_due_feeds(feeds, states, now, limit)
+    # Claim due feeds first, so that an overlapping crawl doesn't
+    # fetch them again.
+    claimed_states = []
+    for feed_id, feed_uri in due_feeds:
+        state = states.get(feed_id)
+        if state is None or state.feed_uri != feed_uri:
+            state = CrawlState(key_name=feed_id, feed_uri=feed_uri)
+            states[feed_id] = state
+        state.next_crawl_at = now + datetime.timedelta(seconds=CRAWL_LEASE)
+        claimed_states.append(state)
+    db_put(claimed_states)
+    put_rpcs = []
+    responses = fetch_feeds(due_feeds, states, concurrency)
+    for feed_id, feed_uri, response in responses:
+        state = states[feed_id]
+        crawl_feed(feed_id, feed_uri, response, state, now, logger)
+        # Each state is stored as soon as the feed is done, so that
+        # an interrupted crawl doesn't lose the others.
+        put_rpcs.append(db_put_async(state))
+    for rpc in put_rpcs:
+        rpc.get_result()
+
+
+def crawl_feed(feed_id, feed_uri, response, state, now, logger):
+    """Merge the fetched feed, and then reschedule its next crawl.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :param feed_uri: the feed url
+    :type feed_uri: :class:`basestring`
+    :param response: the response of the feed or the error of the request
+    :param state: the crawl state of the feed to update
+    :type state: :class:`CrawlState`
+    :param now: the time of the crawl
+    :type now: :class:`datetime.datetime`
+    :param logger: the logger to report the crawl
+    :type logger: :class:`logging.Logger`
+
+    """
+    if isinstance(response, UrlFetchError):
+        logger.warning('failed to fetch %s: %s', feed_uri, response)
+        state.reschedule(now, failed=True)
+        return
+    elif response.status_code == 304:
+        logger.info('%s is not modified', feed_uri)
+        state.reschedule(now)
+        return
+    elif response.status_code != 200:
+        logger.warning('failed to fetch %s: %d',
+                       feed_uri, response.status_code)
+        state.reschedule(now, failed=True)
+        return
+    parser = get_format(response.content)
+    if parser is None:
+        logger.warning('failed to detect the format of %s', feed_uri)
+        state.reschedule(now, failed=True)
+        return
+    try:
+        crawled_feed, _ = parser(response.content, feed_uri)
+    except Exception as e:
+        logger.exception('failed to parse %s: %s', feed_uri, e)
+        state.reschedule(now, failed=True)
+        return
+    try:
+        new_count = merge_feed(feed_id, feed_uri, crawled_feed)
+    except Exception as e:
+        logger.exception('failed to merge %s: %s', feed_uri, e)
+        state.reschedule(now, failed=True)
+        return
+    logger.info('%d new entries of %s', new_count, feed_uri)
+    # The validators are updated only after the feed is merged, so that
+    # a failed merge is retried by an unconditional request.
+    state.etag = response.headers.get('ETag')
+    state.last_modified = response.headers.get('Last-Modified')
+    state.reschedule(now, crawled_feed.entries, changed=bool(new_count))
+
+
+@mod.route('/crawl/')
+def crawl():
+    # The task is named by the period, so that retried cron requests
+    # don't start crawls more than once.
+    task_name = 'crawl-feeds-{0}'.format(int(time.time() // CRAWL_PERIOD))
+    try:
+        defer(crawl_feeds, _name=task_name)
+    except (TaskAlreadyExistsError, TombstonedTaskError):
+        pass
+    return ''
@@ -49,11 +49,11 @@ def get_auth_flow(redirect_on_fail=True):
         raise Redirect(url_for('.appkey_form'))
 
 
-def get_client(redirect_on_fail=True):
+def get_client(redirect_on_fail=True, rest_client=RestClient):
     access_token = get_config('dropbox_access_token')
     if access_token:
-        client = DropboxClient(access_token, rest_client=RestClient)
-        client.session.rest_client = RestClient
+        client = DropboxClient(access_token, rest_client=rest_client)
+        client.session.rest_client = rest_client
         return client
     if redirect_on_fail:
         raise Redirect(url_for('.start_auth'))
@@ -150,9 +150,9 @@ def wait_sync():
         return redirect(url_for('reader.subscriptions'))
     try:
         completed, total = get_config('dropbox_sync_progress')
-    except TypeError:
-        completed, total = 0, 1
-    ratio = fractions.Fraction(completed, total)
+        ratio = fractions.Fraction(min(completed, total), total)
+    except (TypeError, ZeroDivisionError):
+        ratio = fractions.Fraction(0)
     return render_template('dropbox/wait_sync.html', ratio=ratio)
 
 
@@ -0,0 +1,127 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+
+import hashlib
+import json
+
+from google.appengine.ext.db import BlobProperty, Key, Model
+
+from .cache import get, set as put
+from .repository import make_db_key
+
+__all__ = ('EntryIndex', 'build_entry_index', 'find_entry_position',
+           'get_entry_index', 'get_entry_key', 'make_entry_index_key')
+
+
+def get_entry_key(entry):
+    entry_id = entry.id
+    if entry_id.startswith(('http://', 'https://')):
+        entry_id = hashlib.sha1(entry_id).hexdigest()
+    return entry_id
+
+
+class EntryIndex(Model):
+    """The index of a feed that maps entry keys (see :func:`get_entry_key()`)
+    to their positions in the feed.  It's stored under the directory slot of
+    the feed.  Since positions are verified when they are looked up,
+    an outdated index is simply rebuilt.
+
+    """
+
+    #: (:class:`str`) The JSON-encoded mapping of entry keys to positions.
+    positions = BlobProperty(required=True)
+
+
+def make_entry_index_key(feed_id):
+    return Key.from_path('EntryIndex', feed_id,
+                         parent=make_db_key(['feeds', feed_id]))
+
+
+def get_entry_index(feed_id):
+    """Get the entry index of the feed.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :returns: the mapping of entry keys to their positions.
+              :const:`None` if the feed isn't indexed yet
+    :rtype: :class:`collections.Mapping`
+
+    """
+    cached = get(feed_id, namespace='entry_index')
+    if cached is not None:
+        return cached
+    index = EntryIndex.get(make_entry_index_key(feed_id))
+    if index is None:
+        return
+    positions = json.loads(index.positions)
+    put(feed_id, positions, namespace='entry_index')
+    return positions
+
+
+def build_entry_index(feed_id, feed, previous_positions=None):
+    """(Re)build the entry index of the ``feed``.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :param feed: the feed to index
+    :type feed: :class:`libearth.feed.Feed`
+    :param previous_positions: the outdated index if there is.
+                               the index isn't stored if nothing changed
+    :type previous_positions: :class:`collections.Mapping`
+    :returns: the mapping of entry keys to their positions
+    :rtype: :class:`collections.Mapping`
+
+    """
+    positions = dict((get_entry_key(entry), i)
+                     for i, entry in enumerate(feed.entries))
+    if positions != previous_positions:
+        EntryIndex(key=make_entry_index_key(feed_id),
+                   positions=json.dumps(positions)).put()
+        put(feed_id, positions, namespace='entry_index')
+    return positions
+
+
+def find_entry_position(feed_id, feed, entry_key):
+    """Find the position of the entry of the given ``entry_key`` in
+    the ``feed``.  The position is looked up by the index, and then
+    verified by parsing only entries up to the position.  If the index is
+    missing or outdated, it scans entries linearly and rebuilds the index.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :param feed: the feed to find the entry
+    :type feed: :class:`libearth.feed.Feed`
+    :param entry_key: the entry key made by :func:`get_entry_key()`
+    :type entry_key: :class:`basestring`
+    :returns: the position of the found entry.  :const:`None` if
+              there's no such entry
+    :rtype: :class:`numbers.Integral`
+
+    """
+    positions = get_entry_index(feed_id)
+    if positions is not None:
+        position = positions.get(entry_key)
+        if position is not None:
+            try:
+                entry = feed.entries[position]
+            except IndexError:
+                pass
+            else:
+                if get_entry_key(entry) == entry_key:
+                    return position
+    positions = build_entry_index(feed_id, feed, positions)
+    return positions.get(entry_key)
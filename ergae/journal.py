@@ -0,0 +1,117 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+
+import hashlib
+
+from google.appengine.ext.db import DateTimeProperty, Key, Model
+from google.appengine.ext.db import delete as db_delete
+
+from .cache import delete, get, set as put
+from .index import get_entry_key
+from .stage import get_stage
+from .util import defer_coalesced
+
+__all__ = ('COMPACTION_WINDOW', 'ReadMark', 'compact_read_journal',
+           'get_read_marks', 'mark_read')
+
+
+#: (:class:`numbers.Integral`) Seconds to collect read marks of a feed
+#: before they are compacted into the feed document.
+COMPACTION_WINDOW = 5 * 60
+
+
+class ReadMark(Model):
+    """A journaled read mark of an entry.  Its key name is the entry key
+    (see :func:`~.index.get_entry_key()`), and its parent is the journal
+    of the feed (see :func:`make_journal_key()`).  Read marks are merged
+    into the feed document by :func:`compact_read_journal()` in background.
+
+    """
+
+    marked_at = DateTimeProperty(required=True, auto_now_add=True)
+
+
+def make_journal_key(feed_id):
+    return Key.from_path('ReadJournal', feed_id)
+
+
+def get_read_marks(feed_id):
+    """Get the entry keys that were marked as read but not compacted into
+    the feed document yet.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :returns: the set of entry keys
+    :rtype: :class:`collections.Set`
+
+    """
+    cached = get(feed_id, namespace='read_journal')
+    if cached is not None:
+        return cached
+    query = ReadMark.all(keys_only=True).ancestor(make_journal_key(feed_id))
+    marks = frozenset(key.name() for key in query.run())
+    put(feed_id, marks, namespace='read_journal')
+    return marks
+
+
+def mark_read(feed_id, entry_key):
+    """Journal that the entry was read.  It doesn't rewrite the feed
+    document, but schedules the compaction of the journal instead.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :param entry_key: the entry key
+    :type entry_key: :class:`basestring`
+
+    """
+    ReadMark(key_name=entry_key, parent=make_journal_key(feed_id)).put()
+    delete(feed_id, namespace='read_journal')
+    name = 'compact-read-journal-' + hashlib.sha1(feed_id).hexdigest()
+    defer_coalesced(name, COMPACTION_WINDOW, compact_read_journal, feed_id)
+
+
+def compact_read_journal(feed_id):
+    """Merge the journaled read marks into the feed document at once,
+    and then clear them.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+
+    """
+    marks = ReadMark.all(keys_only=True) \
+                    .ancestor(make_journal_key(feed_id)) \
+                    .fetch(None)
+    if not marks:
+        return
+    entry_keys = frozenset(key.name() for key in marks)
+    stage = get_stage()
+    with stage:
+        try:
+            feed = stage.feeds[feed_id]
+        except LookupError:
+            pass
+        else:
+            changed = False
+            for entry in feed.entries:
+                if not entry.read and get_entry_key(entry) in entry_keys:
+                    entry.read = True
+                    changed = True
+            if changed:
+                stage.feeds[feed_id] = feed
+    # Marks journaled during the compaction remain for the next one.
+    db_delete(marks)
+    delete(feed_id, namespace='read_journal')
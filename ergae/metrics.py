@@ -0,0 +1,405 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+from flask import Blueprint, jsonify
+from google.appengine.api import apiproxy_stub_map, memcache
+
+__all__ = ('FLUSH_INTERVAL', 'LATENCY_BUCKETS', 'Counter', 'Histogram',
+           'MeasuredIterator', 'Operation', 'count_bytes', 'counters',
+           'flush', 'get_counter', 'get_counters', 'get_histogram',
+           'instrument', 'measure', 'mod', 'summarize')
+
+
+#: (:class:`numbers.Real`) Seconds to buffer metrics in the instance
+#: before they are flushed to memcache and logs.
+FLUSH_INTERVAL = 10
+
+#: (:class:`collections.Sequence`) The upper bounds of latency histogram
+#: buckets in milliseconds.  Larger values fall into the last ``inf`` bucket.
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+#: (:class:`collections.MutableMapping`) The registry of all counters
+#: by their names.
+counters = {}
+
+#: (:class:`collections.MutableMapping`) The registry of all histograms
+#: by their names.
+histograms = {}
+
+unsaved_names = set()
+registry_lock = threading.RLock()
+local = threading.local()
+
+
+mod = Blueprint('metrics', __name__, url_prefix='/metrics')
+
+
+class Counter(object):
+    """An application-wide counter in memcache.  It's registered to
+    :data:`counters` when it's made.  Increments are buffered in
+    the instance, and then applied together by :func:`flush()`.
+    Since memcache may evict it, it's only for monitoring.
+
+    :param name: the unique name of the counter
+    :type name: :class:`str`
+    :param description: the description of what it counts
+    :type description: :class:`basestring`
+
+    """
+
+    def __init__(self, name, description=None):
+        self.name = name
+        self.description = description
+        with registry_lock:
+            if name in counters:
+                raise ValueError('counter {0!r} already exists'.format(name))
+            counters[name] = self
+            unsaved_names.add(name)
+
+    def increment(self, delta=1):
+        get_buffer()[self.name] += delta
+
+    def get(self):
+        return memcache.get(self.name, namespace='metrics') or 0
+
+    def __repr__(self):
+        return '<{0.__module__}.{0.__name__} {1!r}>'.format(type(self),
+                                                            self.name)
+
+
+class Histogram(object):
+    """A histogram of observed values e.g. latencies, which consists of
+    a :class:`Counter` for each bucket, and the count and the sum of
+    the observed values.  It's registered to :data:`histograms`
+    when it's made.
+
+    :param name: the unique name of the histogram
+    :type name: :class:`str`
+    :param buckets: the upper bounds of buckets in ascending order
+    :type buckets: :class:`collections.Sequence`
+
+    """
+
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.bucket_counters = [get_counter('{0}.le_{1}'.format(name, bound))
+                                for bound in self.buckets]
+        self.count_counter = get_counter(name + '.count')
+        self.sum_counter = get_counter(name + '.sum')
+        with registry_lock:
+            if name in histograms:
+                raise ValueError(
+                    'histogram {0!r} already exists'.format(name)
+                )
+            histograms[name] = self
+
+    def observe(self, value):
+        for bound, counter in zip(self.buckets, self.bucket_counters):
+            if value <= bound:
+                counter.increment()
+                break
+        self.count_counter.increment()
+        self.sum_counter.increment(int(value))
+
+    def __repr__(self):
+        return '<{0.__module__}.{0.__name__} {1!r}>'.format(type(self),
+                                                            self.name)
+
+
+def get_counter(name, description=None):
+    """Get the counter of the ``name``.  It's made if not exists yet.
+    It's safe to call from concurrent threads.
+
+    """
+    try:
+        return counters[name]
+    except KeyError:
+        with registry_lock:
+            counter = counters.get(name)
+            return Counter(name, description) if counter is None else counter
+
+
+def get_histogram(name, buckets=LATENCY_BUCKETS):
+    """Get the histogram of the ``name``.  It's made if not exists yet.
+    It's safe to call from concurrent threads.
+
+    """
+    try:
+        return histograms[name]
+    except KeyError:
+        with registry_lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(name, buckets)
+            return histogram
+
+
+def get_buffer():
+    try:
+        return local.buffer
+    except AttributeError:
+        local.buffer = collections.Counter()
+        local.flushed_at = time.time()
+        return local.buffer
+
+
+def flush():
+    """Apply buffered increments of the current thread to memcache
+    by one RPC, and log them as a JSON object.
+
+    """
+    buffer_ = get_buffer()
+    local.flushed_at = time.time()
+    if unsaved_names:
+        # Names are shared through memcache, so that the admin endpoint
+        # reports counters that its instance didn't touch yet.
+        names = unsaved_names.copy()
+        saved_names = memcache.get('names', namespace='metrics_names')
+        memcache.set('names', (saved_names or frozenset()) | names,
+                     namespace='metrics_names')
+        unsaved_names.difference_update(names)
+    if not buffer_:
+        return
+    deltas = dict(buffer_)
+    buffer_.clear()
+    memcache.offset_multi(deltas, namespace='metrics', initial_value=0)
+    logging.getLogger(__name__ + '.flush').info(
+        'metrics %s', json.dumps(deltas, sort_keys=True)
+    )
+
+
+def count_rpc(service, call, request, response):
+    local.rpc_count = getattr(local, 'rpc_count', 0) + 1
+    get_counter('rpc.' + service).increment()
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('ergae.metrics',
+                                                    count_rpc)
+
+
+@contextlib.contextmanager
+def measure(name, flush_after=False):
+    """Measure the latency (``<name>.latency_ms`` histogram), the number of
+    calls (``<name>.calls``) and RPCs (``<name>.rpcs``) of the operation
+    in the context.  Metrics are flushed when the outermost measured
+    operation ends if :const:`FLUSH_INTERVAL` passed or ``flush_after``
+    is :const:`True`.
+
+    :param name: the operation name e.g. ``'repository.read'``
+    :type name: :class:`str`
+    :param flush_after: whether to flush metrics after the operation.
+                        it's useful for operations that are the whole
+                        task e.g. :func:`~.repository.push_to_dropbox()`
+    :type flush_after: :class:`bool`
+
+    """
+    operation = Operation(name, flush_after)
+    try:
+        with operation.step():
+            yield
+    finally:
+        operation.finish()
+
+
+class Operation(object):
+    """A measured operation of which latency and RPCs are summed up over
+    its steps, so that an operation like streaming can be measured only
+    while its steps run, not while its consumer does.
+    See also :func:`measure()`.
+
+    :param name: the operation name e.g. ``'repository.read'``
+    :type name: :class:`str`
+    :param flush_after: whether to flush metrics after the operation
+    :type flush_after: :class:`bool`
+
+    """
+
+    def __init__(self, name, flush_after=False):
+        self.name = name
+        self.flush_after = flush_after
+        self.elapsed = 0
+        self.rpcs = 0
+        self.finished = False
+
+    @contextlib.contextmanager
+    def step(self):
+        get_buffer()
+        depth = getattr(local, 'depth', 0)
+        rpc_count = getattr(local, 'rpc_count', 0)
+        local.depth = depth + 1
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            local.depth = depth
+            self.elapsed += (time.time() - started_at) * 1000
+            self.rpcs += getattr(local, 'rpc_count', 0) - rpc_count
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        get_histogram(self.name + '.latency_ms').observe(self.elapsed)
+        get_counter(self.name + '.calls').increment()
+        get_counter(self.name + '.rpcs').increment(self.rpcs)
+        if not getattr(local, 'depth', 0) and (
+            self.flush_after or
+            time.time() - local.flushed_at >= FLUSH_INTERVAL
+        ):
+            flush()
+
+
+class MeasuredIterator(object):
+    """Pass through the ``iterator`` while measuring its iteration as
+    the rest of the ``operation``, which finishes when the iterator is
+    exhausted or closed.
+
+    :param operation: the operation that made the iterator
+    :type operation: :class:`Operation`
+    :param iterator: the iterator to measure
+    :type iterator: :class:`collections.Iterator`
+
+    """
+
+    def __init__(self, operation, iterator):
+        self.operation = operation
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            with self.operation.step():
+                return next(self.iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        close = getattr(self.iterator, 'close', None)
+        if callable(close):
+            close()
+        self.operation.finish()
+
+
+def instrument(name, flush_after=False, iterates=False):
+    """The decorator version of :func:`measure()`.  If ``iterates`` is
+    :const:`True` the function returns an iterable, and the operation
+    lasts until it's exhausted (see :class:`MeasuredIterator`).
+
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            if not iterates:
+                with measure(name, flush_after):
+                    return function(*args, **kwargs)
+            operation = Operation(name, flush_after)
+            try:
+                with operation.step():
+                    iterator = iter(function(*args, **kwargs))
+            except BaseException:
+                operation.finish()
+                raise
+            return MeasuredIterator(operation, iterator)
+        return instrumented
+    return decorate
+
+
+def count_bytes(chunks, name):
+    """Pass through ``chunks`` while counting their bytes in the counter
+    of the ``name``.
+
+    :param chunks: byte chunks
+    :type chunks: :class:`collections.Iterable`
+    :param name: the counter name e.g. ``'repository.read.bytes'``
+    :type name: :class:`str`
+    :returns: the same chunks
+    :rtype: :class:`collections.Iterable`
+
+    """
+    counter = get_counter(name)
+    for chunk in chunks:
+        counter.increment(len(chunk))
+        yield chunk
+
+
+def get_counters():
+    """Get the current values of all counters at once, including counters
+    made by other instances.
+
+    :returns: the mapping of counter names to their values
+    :rtype: :class:`collections.Mapping`
+
+    """
+    names = set(counters)
+    names.update(memcache.get('names', namespace='metrics_names') or ())
+    values = memcache.get_multi(list(names), namespace='metrics')
+    return dict((name, values.get(name, 0)) for name in names)
+
+
+def summarize(values):
+    """Summarize counter ``values`` into histograms and cache hit ratios.
+
+    :param values: the mapping of counter names to their values
+                   (see :func:`get_counters()`)
+    :type values: :class:`collections.Mapping`
+    :returns: a pair of the mapping of histogram names to their buckets,
+              count and sum, and the mapping of cache namespaces to
+              their hit ratios
+    :rtype: :class:`tuple`
+
+    """
+    histograms_ = collections.defaultdict(lambda: {'buckets': {}})
+    for name, value in values.iteritems():
+        prefix, _, field = name.rpartition('.')
+        if field.startswith('le_'):
+            histograms_[prefix]['buckets'][field[3:]] = value
+    cache_stats = collections.defaultdict(collections.Counter)
+    for name, value in values.iteritems():
+        prefix, _, field = name.rpartition('.')
+        if prefix in histograms_:
+            if field in ('count', 'sum'):
+                histograms_[prefix][field] = value
+        elif name.startswith('cache.'):
+            cache_stats[prefix[len('cache.'):]][field] = value
+    hit_ratios = {}
+    for namespace, stats in cache_stats.iteritems():
+        total = stats['local_hits'] + stats['hits'] + stats['misses']
+        if total:
+            hit_ratios[namespace] = \
+                float(stats['local_hits'] + stats['hits']) / total
+    return dict(histograms_), hit_ratios
+
+
+@mod.route('/')
+def metrics():
+    values = get_counters()
+    histograms_, hit_ratios = summarize(values)
+    return jsonify(counters=values, histograms=histograms_,
+                   cache_hit_ratios=hit_ratios)
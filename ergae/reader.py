@@ -16,18 +16,29 @@
 from __future__ import absolute_import
 
 import hashlib
+import itertools
 
-from flask import Blueprint, g, redirect, render_template, request, url_for
+from flask import (Blueprint, g, jsonify, redirect, render_template, request,
+                   url_for)
 from google.appengine.api.users import get_current_user
 from jinja2 import Markup
 from libearth.defaults import get_default_subscriptions
 from libearth.feed import Person
 from werkzeug.exceptions import NotFound
 
-from .config import get_config
+from .cache import get_multi, set_multi
+from .config import get_configs
+from .index import find_entry_position, get_entry_key
+from .journal import get_read_marks, mark_read
+from .sidebar import get_sidebar
 from .stage import get_stage
+from .unread import get_unread_counts, update_unread_count
 
-__all__ = 'mod',
+__all__ = 'ENTRIES_PER_PAGE', 'mod'
+
+
+#: (:class:`numbers.Integral`) The number of entries to list at a time.
+ENTRIES_PER_PAGE = 30
 
 
 mod = Blueprint('reader', __name__)
@@ -35,21 +46,26 @@ mod = Blueprint('reader', __name__)
 
 @mod.before_request
 def setup_stage():
-    if not (get_config('dropbox_app_key') and get_config('dropbox_app_secret')):
+    config = get_configs([
+        'dropbox_app_key', 'dropbox_app_secret',
+        'dropbox_access_token', 'dropbox_user_id',
+        'dropbox_path', 'dropbox_last_sync'
+    ])
+    if not (config['dropbox_app_key'] and config['dropbox_app_secret']):
         return redirect(url_for('dropbox.appkey_form'))
-    elif not (get_config('dropbox_access_token') and
-              get_config('dropbox_user_id')):
+    elif not (config['dropbox_access_token'] and config['dropbox_user_id']):
         return redirect(url_for('dropbox.start_auth'))
-    elif not (get_config('dropbox_path') and get_config('dropbox_last_sync')):
+    elif not (config['dropbox_path'] and config['dropbox_last_sync']):
         return redirect(url_for('dropbox.browse_folder'))
     g.stage = get_stage()
-    with g.stage:
-        subscriptions = g.stage.subscriptions
-        exceptions = {'reader.initialize_subscriptions_form',
-                      'reader.initialize_subscriptions'}
-        if request.endpoint not in exceptions and \
-           not (subscriptions and subscriptions.head and subscriptions.owner):
-            return redirect(url_for('.initialize_subscriptions_form'))
+    g.sidebar = get_sidebar(g.stage)
+    g.unread_total, g.unread_counts = get_unread_counts(
+        item.feed_id for item in g.sidebar.subscriptions
+    )
+    exceptions = {'reader.initialize_subscriptions_form',
+                  'reader.initialize_subscriptions'}
+    if request.endpoint not in exceptions and not g.sidebar.initialized:
+        return redirect(url_for('.initialize_subscriptions_form'))
 
 
 @mod.route('/')
@@ -108,15 +124,12 @@ def initialize_subscriptions():
 
 @mod.route('/feeds/')
 def subscriptions():
-    with g.stage:
-        return render_template('reader/subscriptions.html')
+    return render_template('reader/subscriptions.html')
 
 
-def get_entry_key(entry):
-    entry_id = entry.id
-    if entry_id.startswith(('http://', 'https://')):
-        entry_id = hashlib.sha1(entry_id).hexdigest()
-    return entry_id
+@mod.route('/feeds/unread/')
+def unread_counts():
+    return jsonify(total=g.unread_total, feeds=g.unread_counts)
 
 
 @mod.context_processor
@@ -124,16 +137,77 @@ def register_functions():
     return {'get_entry_key': get_entry_key}
 
 
+def get_excerpt(entry):
+    text = entry.summary or entry.content
+    excerpt = unicode(text).strip() if text else u''
+    return excerpt and excerpt.splitlines()[0]
+
+
+def get_entry_page(feed, start=0):
+    """Get the page of entries that begins at the ``start`` position.
+    Entries after the page aren't parsed at all.  Excerpts are cached
+    by entry keys and update times.
+
+    :param feed: the feed to list entries
+    :type feed: :class:`libearth.feed.Feed`
+    :param start: the position of the first entry of the page
+    :type start: :class:`numbers.Integral`
+    :returns: a pair of the list of (entry, entry key, excerpt) triples,
+              and the cursor of the next page (:const:`None` if it's
+              the last page)
+    :rtype: :class:`tuple`
+
+    """
+    entries = list(itertools.islice(feed.entries,
+                                    start, start + ENTRIES_PER_PAGE + 1))
+    has_next = len(entries) > ENTRIES_PER_PAGE
+    del entries[ENTRIES_PER_PAGE:]
+    entry_keys = [get_entry_key(entry) for entry in entries]
+    cache_keys = [
+        hashlib.sha1(u'{0} {1}'.format(
+            entry_key, entry.updated_at and entry.updated_at.isoformat()
+        ).encode('utf-8')).hexdigest()
+        for entry, entry_key in zip(entries, entry_keys)
+    ]
+    excerpts = get_multi(cache_keys, namespace='excerpt')
+    missing_excerpts = {}
+    for entry, cache_key in zip(entries, cache_keys):
+        if cache_key not in excerpts:
+            missing_excerpts[cache_key] = get_excerpt(entry)
+    if missing_excerpts:
+        set_multi(missing_excerpts, namespace='excerpt')
+        excerpts.update(missing_excerpts)
+    page = [(entry, entry_key, excerpts[cache_key])
+            for entry, entry_key, cache_key
+            in zip(entries, entry_keys, cache_keys)]
+    return page, entry_keys[-1] if has_next else None
+
+
 @mod.route('/feeds/<feed_id>/')
 def feed(feed_id):
+    after = request.args.get('after')
     with g.stage:
         try:
             feed_ = g.stage.feeds[feed_id]
         except LookupError:
             raise NotFound()
+        start = 0
+        if after:
+            position = find_entry_position(feed_id, feed_, after)
+            if position is None:
+                raise NotFound()
+            start = position + 1
+        entry_page, next_cursor = get_entry_page(feed_, start)
+        # Infinite scroll requests only the entry list of the next page
+        if request.is_xhr:
+            template = 'reader/entry_list.html'
+        else:
+            template = 'reader/feed.html'
         return render_template(
-            'reader/feed.html',
-            feed_id=feed_id, feed=feed_
+            template,
+            feed_id=feed_id, feed=feed_,
+            entry_page=entry_page, next_cursor=next_cursor,
+            read_marks=get_read_marks(feed_id)
         )
 
 
@@ -141,14 +215,21 @@ def feed(feed_id):
 def entry(feed_id, entry_key):
     with g.stage:
         feed_ = g.stage.feeds[feed_id]
-        for entry_ in feed_.entries:
-            if get_entry_key(entry_) == entry_key:
-                break
-        else:
+        position = find_entry_position(feed_id, feed_, entry_key)
+        if position is None:
             raise NotFound()
-        if not entry_.read:
-            entry_.read = True
-            g.stage.feeds[feed_id] = feed_
+        entry_ = feed_.entries[position]
+        entry_page, next_cursor = get_entry_page(
+            feed_,
+            position - position % ENTRIES_PER_PAGE
+        )
+        read_marks = get_read_marks(feed_id)
+        if not entry_.read and entry_key not in read_marks:
+            mark_read(feed_id, entry_key)
+            # The count is corrected by the recount after the compaction
+            # of the journal even if it's raced with another recount.
+            update_unread_count(feed_id, lambda count: count and count - 1)
+            read_marks = read_marks | frozenset([entry_key])
         content = entry_.content or entry_.summary
         permalink = entry_.links.permalink or feed_.links.permalink
         assert permalink
@@ -156,6 +237,8 @@ def entry(feed_id, entry_key):
         return render_template(
             'reader/entry.html',
             feed_id=feed_id, feed=feed_,
+            entry_page=entry_page, next_cursor=next_cursor,
+            read_marks=read_marks,
             entry_key=entry_key, entry=entry_, entry_permalink=permalink,
             entry_content=Markup(content)
         )
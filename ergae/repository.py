@@ -15,40 +15,75 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import
 
+import collections
 import datetime
 import hashlib
+import json
 import logging
 import operator
+import os
 import random
-import re
 import rfc822
 import time
+import zlib
 
 from google.appengine.api.files import finalize, open as fopen
 from google.appengine.api.files.blobstore import create, get_blob_key
-from google.appengine.api.memcache import (delete, delete_multi,
-                                           get, set as put)
-from google.appengine.ext.blobstore import BlobInfo, BlobReferenceProperty
-from google.appengine.ext.db import (DateTimeProperty, EntityNotFoundError,
-                                     IntegerProperty, Model, Key,
-                                     StringProperty,
+from google.appengine.ext.blobstore import (BlobInfo, BlobReferenceProperty,
+                                            delete as blob_delete,
+                                            fetch_data_async)
+from google.appengine.ext.db import (BooleanProperty, DateTimeProperty,
+                                     EntityNotFoundError, IntegerProperty,
+                                     Model, Key, StringListProperty,
+                                     StringProperty, TextProperty,
                                      create_transaction_options,
+                                     delete as db_delete, get as db_get,
+                                     put as db_put,
+                                     run_in_transaction,
                                      run_in_transaction_options)
 from google.appengine.ext.deferred import defer
 import itertools
 from libearth.repository import Repository, RepositoryKeyError
 
-from .config import get_config, set_config
+from .cache import (add_multi, delete, delete_multi, get, get_multi,
+                    set as put, set_multi)
+from .config import get_config, set_config, update_config
 from .dropbox import get_client
+from .metrics import Counter, count_bytes, get_counter, instrument
+from .rest import AsyncRestClient, RestClient, wait_any
+from .sidebar import invalidate_sidebar, is_subscription_list_key
+from .util import defer_coalesced
 
-__all__ = ('INCOMING_BYTES_LIMIT', 'OUTGOING_BYTES_LIMIT',
-           'DataStoreRepository', 'Slot',
-           'make_db_key', 'pull_from_dropbox', 'push_to_dropbox')
+__all__ = ('INCOMING_BYTES_LIMIT', 'OUTGOING_BYTES_LIMIT', 'PULL_BYTES_BUDGET',
+           'PULL_CONCURRENCY', 'SYNC_BATCH_SIZE', 'SYNC_STATE_KEY',
+           'DataStoreRepository', 'Slot', 'SyncBatch', 'SyncState',
+           'apply_sync_batch', 'download_files', 'fetch_delta_page',
+           'invalidate_derived_caches', 'make_db_key', 'pull_from_dropbox',
+           'push_to_dropbox', 'schedule_push')
 
 
 INCOMING_BYTES_LIMIT = 30 * 1000 * 1000  # 30MB
 OUTGOING_BYTES_LIMIT = 9 * 1000 * 1000  # 9MB
 CACHE_BYTES_LIMIT = 1000 * 1000 - 256 - 96  # 1MB - cache key size - 96 bytes
+CACHE_PARTS_LIMIT = 10  # the maximum number of parts to split a cached slot
+READ_CHUNK_BYTES = 64 * 1024  # 64KB
+READ_AHEAD_CHUNKS = 8  # the number of blob chunks to fetch ahead of reading
+SLOT_CODEC = 'zlib'  # the codec to compress slots with; None to disable
+COMPRESSION_LEVEL = 6
+PULL_CONCURRENCY = 10  # the number of files to download at a time
+PULL_BYTES_BUDGET = 32 * 1000 * 1000  # 32MB; the bytes to fetch at a time
+PUSH_WINDOW = 10  # seconds to coalesce pushes of the same slot
+SYNC_BATCH_SIZE = 100  # the number of delta entries a task applies
+SYNC_APPLY_SIZE = 20  # the number of entries to apply and checkpoint at once
+
+
+pushed_counter = Counter('push.uploaded', 'slots uploaded to Dropbox')
+pushed_bytes_counter = Counter('push.uploaded_bytes',
+                               'bytes uploaded to Dropbox')
+skipped_counter = Counter('push.skipped',
+                          'pushes skipped since contents are unchanged')
+skipped_bytes_counter = Counter('push.skipped_bytes',
+                                'bytes not uploaded since they are unchanged')
 
 
 class DataStoreRepository(Repository):
@@ -72,33 +107,28 @@ class DataStoreRepository(Repository):
         super(DataStoreRepository, self).to_url(scheme)
         return scheme + '://'
 
+    @instrument('repository.read', iterates=True)
     def read(self, key):
         super(DataStoreRepository, self).read(key)
         cache_key = make_cache_key(key)
-        cached = get(cache_key, namespace='slot')
+        cached = get_cached_slot(cache_key)
         if cached is not None:
-            return cached[1:],
-        db_key = make_db_key(key)
-        slot = Slot.get(db_key)
-        if slot is None:
-            raise RepositoryKeyError(key)
-        blob = slot.blob.open()
-        if slot.blob.size < CACHE_BYTES_LIMIT:
-            put(cache_key, 'F' + blob.read(), namespace='slot')
-            blob.seek(0)
-        return blob
+            codec = CACHE_PREFIX_CODECS.get(cached[:1])
+            chunks = itertools.imap(str, iter_slices(cached, 1))
+        else:
+            slot = Slot.get(make_db_key(key))
+            if slot is None:
+                raise RepositoryKeyError(key)
+            codec = slot.codec
+            chunks = stream_slot(cache_key, slot)
+        return count_bytes(decode_chunks(chunks, codec),
+                           'repository.read.bytes')
 
+    @instrument('repository.write')
     def write(self, key, iterable):
         super(DataStoreRepository, self).write(key, iterable)
-        parent_cache_keys = []
-        for i in xrange(1, len(key)):
-            parent_key = key[:i]
-            if not self.exists(parent_key):
-                Slot(
-                    depth=len(parent_key),
-                    key=make_db_key(parent_key),
-                    blob=None
-                ).put()
+        iterable = count_bytes(iterable, 'repository.write.bytes')
+        parent_cache_keys = make_parent_dirs(key)
         delete_multi(parent_cache_keys, namespace='slot')
         delete_multi(parent_cache_keys, namespace='list')
         size = 0
@@ -110,44 +140,440 @@ class DataStoreRepository(Repository):
                 break
         else:
             cache_key = make_cache_key(key)
-            cache_value = ''.join(itertools.chain('F', cache_value_buffer))
+            encoder = SlotEncoder(SLOT_CODEC)
+            cache_value = ''.join(itertools.chain(
+                [CACHE_PREFIXES[SLOT_CODEC]],
+                itertools.imap(encoder.encode, cache_value_buffer),
+                [encoder.flush()]
+            ))
             put(cache_key, cache_value, namespace='slot')
+            # The slot is updated later by the deferred put_slot(), so
+            # the revision marker tells this write to revision checks.
+            mark_existing([cache_key], revised=True)
+            delete(make_cache_key(key[:-1]), namespace='list')
             defer(put_slot, key, cache_value_buffer)
+            invalidate_derived_caches([key])
             return
         iterable = itertools.chain(cache_value_buffer, iterable)
-        put_slot(key, iterable)
+        put_slot(key, iterable, cache=True)
+        invalidate_derived_caches([key])
 
+    @instrument('repository.exists')
     def exists(self, key):
         super(DataStoreRepository, self).exists(key)
-        if get(make_cache_key(key), namespace='slot') is not None:
+        # Presence markers are kept apart from the cached slot values,
+        # so that it doesn't transfer the whole document only to test it.
+        cache_key = make_cache_key(key)
+        if get(cache_key, namespace='exists') is not None:
             return True
-        list_cache = get(make_cache_key(key[:-1]), namespace='list')
-        if list_cache is None:
-            return tuple(key) in list_cache
-        return Slot.get(make_db_key(key)) is not None
+        if key:
+            list_cache = get(make_cache_key(key[:-1]), namespace='list')
+            if list_cache is not None:
+                return key[-1] in list_cache
+        db_key = make_db_key(key)
+        query = Slot.all(keys_only=True).ancestor(db_key) \
+                    .filter('__key__ =', db_key)
+        if query.get() is None:
+            return False
+        mark_existing([cache_key])
+        return True
 
+    @instrument('repository.list')
     def list(self, key):
         super(DataStoreRepository, self).list(key)
         cache_key = make_cache_key(key)
         list_cache = get(cache_key, namespace='list')
         if list_cache is not None:
             return list_cache
+        # Slots are stored in the entity group of their ancestor directories,
+        # and the depth property tells direct children from the others in
+        # the subtree.  The ancestor and equality filters are served by
+        # the built-in indexes, so it scans only the direct children.
+        query = Slot.all(keys_only=True).filter('depth =', len(key) + 1)
         if key:
             parent_db_key = make_db_key(key)
-            db_keys = Slot.all().ancestor(parent_db_key).run(keys_only=True)
-            if key and not db_keys and Slot.get(parent_db_key) is None:
+            db_keys = list(query.ancestor(parent_db_key).run())
+            if not db_keys and Slot.get(parent_db_key) is None:
                 raise RepositoryKeyError(key)
         else:
-            db_keys = Slot.all().filter('depth <=', 1).run(keys_only=True)
-        key_names = [db_key.name() for db_key in db_keys]
-        children = frozenset(KEY_LAST_PART_PATTERN.search(key_name).group(1)
-                             for key_name in key_names)
-        put(cache_key, 'D', namespace='slot')
+            db_keys = query.run()
+        children = frozenset(db_key.name().rsplit('/', 1)[-1]
+                             for db_key in db_keys)
+        mark_existing([cache_key])
         put(cache_key, children, namespace='list')
         return children
 
 
-KEY_LAST_PART_PATTERN = re.compile(r'(?:^|/)([^/]+)$')
+def make_parent_dirs(key):
+    """Create missing ancestor directories of the ``key``.  Directories
+    known to exist by their presence markers (see :func:`mark_existing()`)
+    are skipped, and the rest are looked up and created in a batch.
+
+    :param key: the key of the slot to write
+    :type key: :class:`collections.Sequence`
+    :returns: the cache keys of directories of which listings changed
+    :rtype: :class:`collections.Sequence`
+
+    """
+    parent_keys = [key[:i] for i in xrange(1, len(key))]
+    cache_keys = map(make_cache_key, parent_keys)
+    known = get_multi(cache_keys, namespace='exists')
+    unknown = [(parent_key, cache_key)
+               for parent_key, cache_key in zip(parent_keys, cache_keys)
+               if cache_key not in known]
+    if not unknown:
+        return []
+    db_keys = [make_db_key(parent_key) for parent_key, _ in unknown]
+    missing = [(parent_key, db_key)
+               for (parent_key, _), db_key, slot
+               in zip(unknown, db_keys, db_get(db_keys))
+               if slot is None]
+    db_put([Slot(depth=len(parent_key), key=db_key, blob=None)
+            for parent_key, db_key in missing])
+    mark_existing(cache_key for _, cache_key in unknown)
+    return [make_cache_key(parent_key[:-1]) for parent_key, _ in missing]
+
+
+def mark_existing(cache_keys, revised=False):
+    """Mark slots of the given ``cache_keys`` as existing in the ``exists``
+    namespace, which :meth:`DataStoreRepository.exists()` checks first.
+    Markers have to be deleted when their slots are deleted.
+
+    Slots of which contents are updated are ``revised``, and marked with
+    a unique revision that :class:`~.stage.CachedStage` checks.  Otherwise
+    they are marked with :const:`True` unless they are already marked,
+    so that their revisions are kept.
+
+    :param cache_keys: the cache keys made by :func:`make_cache_key()`
+    :type cache_keys: :class:`collections.Iterable`
+    :param revised: whether contents of the slots are updated
+    :type revised: :class:`bool`
+
+    """
+    if revised:
+        set_multi(dict((cache_key, os.urandom(8).encode('hex'))
+                       for cache_key in cache_keys),
+                  namespace='exists')
+    else:
+        add_multi(dict.fromkeys(cache_keys, True), namespace='exists')
+
+
+def cache_slot(cache_key, value):
+    """Cache the slot ``value`` into the ``slot`` namespace.  Values larger
+    than :const:`CACHE_BYTES_LIMIT` are split into several parts, and
+    the ``cache_key`` holds the manifest of them instead: ``'M'`` followed by
+    the version stamp and the number of parts e.g. ``'M1f2e3d4c:3'``.
+    Values larger than :const:`CACHE_PARTS_LIMIT` parts aren't cached.
+    See also :class:`SlotCacheWriter`.
+
+    :param cache_key: the cache key made by :func:`make_cache_key()`
+    :type cache_key: :class:`str`
+    :param value: the value to cache, which starts with the type prefix
+                  e.g. ``'F'`` (see also :const:`CACHE_PREFIXES`)
+    :type value: :class:`str`
+    :returns: whether it's cached
+    :rtype: :class:`bool`
+
+    """
+    writer = SlotCacheWriter(cache_key, len(value))
+    writer.write(value)
+    return writer.close()
+
+
+class SlotCacheWriter(object):
+    """Incrementally cache the slot value of the known ``size`` in the same
+    way as :func:`cache_slot()`.  Each part is stored as soon as it's
+    filled, so that only a part is buffered at a time.
+
+    :param cache_key: the cache key made by :func:`make_cache_key()`
+    :type cache_key: :class:`str`
+    :param size: the total size of the value to cache
+    :type size: :class:`numbers.Integral`
+
+    """
+
+    def __init__(self, cache_key, size):
+        self.cache_key = cache_key
+        self.size = size
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        if size < CACHE_BYTES_LIMIT:
+            self.part_keys = None
+            self.failed = False
+            return
+        parts_count = -(-size // CACHE_BYTES_LIMIT)
+        self.failed = parts_count > CACHE_PARTS_LIMIT
+        # The version stamp prevents parts of concurrent writes from
+        # being mixed.
+        self.version = os.urandom(8).encode('hex')
+        self.part_keys = make_cache_part_keys(cache_key, self.version,
+                                              parts_count)
+
+    def write(self, chunk):
+        if self.failed:
+            return
+        self.buffer.append(chunk)
+        self.buffered += len(chunk)
+        if self.part_keys is None or self.buffered < CACHE_BYTES_LIMIT:
+            return
+        data = ''.join(self.buffer)
+        while len(data) >= CACHE_BYTES_LIMIT and not self.failed:
+            self.write_part(data[:CACHE_BYTES_LIMIT])
+            data = data[CACHE_BYTES_LIMIT:]
+        self.buffer[:] = [data]
+        self.buffered = len(data)
+
+    def write_part(self, part):
+        index = self.written // CACHE_BYTES_LIMIT
+        if index >= len(self.part_keys) or \
+           not put(self.part_keys[index], part, namespace='slot'):
+            self.failed = True
+        self.written += len(part)
+
+    def close(self):
+        """Store the rest of the value, and then the manifest if it's
+        split into parts.
+
+        :returns: whether the value is cached
+        :rtype: :class:`bool`
+
+        """
+        data = ''.join(self.buffer)
+        del self.buffer[:]
+        if self.part_keys is None:
+            if not self.failed and len(data) == self.size:
+                return put(self.cache_key, data, namespace='slot')
+        elif not self.failed:
+            if data:
+                self.write_part(data)
+            if not self.failed and self.written == self.size:
+                manifest = 'M{0}:{1}'.format(self.version,
+                                             len(self.part_keys))
+                return put(self.cache_key, manifest, namespace='slot')
+        delete(self.cache_key, namespace='slot')
+        return False
+
+
+def get_cached_slot(cache_key):
+    """Get the cached slot value.  If it's split into several parts
+    (see :func:`cache_slot()`), they are fetched by one
+    :func:`~.cache.get_multi()` call and joined.
+
+    :param cache_key: the cache key made by :func:`make_cache_key()`
+    :type cache_key: :class:`str`
+    :returns: the cached value.  :const:`None` if it's not cached or
+              any part of it is evicted
+    :rtype: :class:`str`
+
+    """
+    cached = get(cache_key, namespace='slot')
+    if cached is None or not cached.startswith('M'):
+        return cached
+    version, parts_count = cached[1:].split(':')
+    part_keys = make_cache_part_keys(cache_key, version, int(parts_count))
+    parts = get_multi(part_keys, namespace='slot')
+    if len(parts) < len(part_keys):
+        return
+    return ''.join(parts[part_key] for part_key in part_keys)
+
+
+def make_cache_part_keys(cache_key, version, parts_count):
+    return ['{0}:{1}:{2}'.format(cache_key, version, i)
+            for i in xrange(parts_count)]
+
+
+#: (:class:`collections.Mapping`) The type prefixes of cached file slots
+#: by their codec.  Directories are cached as ``'D'``.
+CACHE_PREFIXES = {None: 'F', 'zlib': 'Z'}
+
+CACHE_PREFIX_CODECS = dict((prefix, codec)
+                           for codec, prefix in CACHE_PREFIXES.items())
+
+
+class SlotEncoder(object):
+    """Incrementally encode the content of a slot with the given ``codec``.
+
+    :param codec: the codec name to compress e.g. ``'zlib'``.
+                  :const:`None` to store the content as it is
+    :type codec: :class:`str`
+
+    """
+
+    def __init__(self, codec):
+        if codec not in CACHE_PREFIXES:
+            raise ValueError('unknown codec: ' + repr(codec))
+        self.codec = codec
+        if codec == 'zlib':
+            self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        else:
+            self.compressor = None
+
+    def encode(self, chunk):
+        if self.compressor is None:
+            return chunk
+        return self.compressor.compress(chunk)
+
+    def flush(self):
+        if self.compressor is None:
+            return ''
+        return self.compressor.flush()
+
+
+def decode_chunks(chunks, codec):
+    """Lazily decode the content of a slot encoded by :class:`SlotEncoder`.
+
+    :param chunks: encoded chunks
+    :type chunks: :class:`collections.Iterable`
+    :param codec: the codec name e.g. ``'zlib'``
+    :type codec: :class:`str`
+    :returns: decoded chunks
+    :rtype: :class:`collections.Iterable`
+
+    """
+    if codec is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    elif codec != 'zlib':
+        raise ValueError('unknown codec: ' + repr(codec))
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        decompressed = decompressor.decompress(chunk)
+        if decompressed:
+            yield decompressed
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def iter_blob_chunks(blob_key, size, chunk_size=READ_CHUNK_BYTES,
+                     read_ahead=READ_AHEAD_CHUNKS):
+    """Iterate over the blob by ``chunk_size`` bytes.  The next
+    ``read_ahead`` chunks are fetched asynchronously while the current
+    chunk is being consumed.
+
+    :param blob_key: the key of the blob to read
+    :type blob_key: :class:`google.appengine.ext.blobstore.BlobKey`
+    :param size: the size of the blob
+    :type size: :class:`numbers.Integral`
+    :param chunk_size: the size of each chunk
+    :type chunk_size: :class:`numbers.Integral`
+    :param read_ahead: the number of chunks to fetch ahead
+    :type read_ahead: :class:`numbers.Integral`
+    :returns: chunks of the blob
+    :rtype: :class:`collections.Iterable`
+
+    """
+    offsets = iter(xrange(0, size, chunk_size))
+    rpcs = collections.deque(
+        fetch_data_async(blob_key, offset, offset + chunk_size - 1)
+        for offset in itertools.islice(offsets, read_ahead + 1)
+    )
+    while rpcs:
+        chunk = rpcs.popleft().get_result()
+        for offset in itertools.islice(offsets, 1):
+            rpcs.append(fetch_data_async(blob_key, offset,
+                                         offset + chunk_size - 1))
+        yield chunk
+
+
+def stream_slot(cache_key, slot):
+    """Stream the encoded content of the ``slot`` from blobstore
+    (see :func:`iter_blob_chunks()`), and cache it as it goes
+    (see :class:`SlotCacheWriter`).  It's cached only if the stream is
+    read to the end.
+
+    :param cache_key: the cache key made by :func:`make_cache_key()`
+    :type cache_key: :class:`str`
+    :param slot: the file slot to read
+    :type slot: :class:`Slot`
+    :returns: encoded chunks of the slot
+    :rtype: :class:`collections.Iterable`
+
+    """
+    blob_key = Slot.blob.get_value_for_datastore(slot)
+    blob_size = slot.blob.size
+    prefix = CACHE_PREFIXES[slot.codec]
+    if blob_size < CACHE_PARTS_LIMIT * CACHE_BYTES_LIMIT:
+        writer = SlotCacheWriter(cache_key, len(prefix) + blob_size)
+        writer.write(prefix)
+    else:
+        writer = None
+    for chunk in iter_blob_chunks(blob_key, blob_size):
+        if writer is not None:
+            writer.write(chunk)
+        yield chunk
+    if writer is not None:
+        writer.close()
+
+
+def iter_slices(data, offset=0, size=READ_CHUNK_BYTES):
+    """Iterate over a string or a file-like object by ``size`` bytes."""
+    if isinstance(data, basestring):
+        for i in xrange(offset, len(data), size):
+            yield buffer(data, i, size)
+        return
+    if offset:
+        data.seek(offset)
+    while 1:
+        chunk = data.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class SlotReader(object):
+    """File-like object that reads the decoded content of a slot blob.
+
+    :param blob_reader: the blob reader of the slot
+    :type blob_reader: :class:`google.appengine.ext.blobstore.BlobReader`
+    :param codec: the codec of the slot
+    :type codec: :class:`str`
+
+    """
+
+    def __init__(self, blob_reader, codec):
+        self.blob_reader = blob_reader
+        self.chunks = decode_chunks(iter_slices(blob_reader), codec)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        buffer_ = [self.buffer]
+        buffered = len(self.buffer)
+        for chunk in self.chunks:
+            buffer_.append(chunk)
+            buffered += len(chunk)
+            if 0 <= size <= buffered:
+                break
+        data = ''.join(buffer_)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.blob_reader.close()
+
+
+def invalidate_derived_caches(keys):
+    """Invalidate caches derived from documents of the changed slots
+    e.g. the subscription sidebar, and schedule to count unread entries
+    of the changed feeds again.
+
+    :param keys: the repository keys of the changed slots
+    :type keys: :class:`collections.Iterable`
+
+    """
+    from .unread import schedule_unread_recount
+    keys = list(keys)
+    if any(is_subscription_list_key(key) for key in keys):
+        invalidate_sidebar()
+    feed_ids = set(key[1] for key in keys
+                   if len(key) == 3 and key[0] == 'feeds')
+    for feed_id in feed_ids:
+        schedule_unread_recount(feed_id)
 
 
 def make_cache_key(key):
@@ -171,25 +597,52 @@ class Slot(Model):
 
     depth = IntegerProperty(required=True)
     blob = BlobReferenceProperty()
+    codec = StringProperty()  # None for uncompressed slots
+    size = IntegerProperty()  # the decoded size
+    digest = StringProperty(indexed=False)  # SHA-1 of the decoded content
     rev = StringProperty()
+    synced_digest = StringProperty(indexed=False)  # digest of the rev
     synced_at = DateTimeProperty()
     updated_at = DateTimeProperty(required=True, auto_now_add=True)
 
     def is_dir(self):
         return self.blob is None
 
+    def is_dirty(self):
+        """Whether it has local changes that aren't pushed to Dropbox yet.
+        It doesn't fetch the referenced blob.
+
+        """
+        if Slot.blob.get_value_for_datastore(self) is None:
+            return False
+        return self.synced_at is None or self.updated_at > self.synced_at
+
     def __repr__(self):
         return '<RepositoryKey {0!r}>'.format(self.path)
 
 
-def put_slot(key, iterable):
+@instrument('put_slot', flush_after=True)
+def put_slot(key, iterable, cache=False):
     db_key = make_db_key(key)
     filename = create(mime_type='text/xml')
+    codec = SLOT_CODEC
+    encoder = SlotEncoder(codec)
+    hash_ = hashlib.sha1()
+    decoded_size = 0
     size = 0
+    cache_buffer = [CACHE_PREFIXES[codec]]
     with fopen(filename, 'ab') as f:
-        for chunk in iterable:
+        for chunk in itertools.chain(iterable, [None]):
+            if chunk is None:
+                chunk = encoder.flush()
+            else:
+                decoded_size += len(chunk)
+                hash_.update(chunk)
+                chunk = encoder.encode(chunk)
             f.write(chunk)
             size += len(chunk)
+            if cache and size < CACHE_PARTS_LIMIT * CACHE_BYTES_LIMIT:
+                cache_buffer.append(chunk)
     finalize(filename)
     blob_key = get_blob_key(filename)
     blob_info = BlobInfo.get(blob_key)
@@ -198,6 +651,7 @@ def put_slot(key, iterable):
     )
     assert isinstance(blob_info, BlobInfo)
     now = datetime.datetime.utcnow()
+    digest = hash_.hexdigest()
     cache_key = make_cache_key(key)
     list_cache_key = make_cache_key(key[:-1])
 
@@ -210,27 +664,38 @@ def put_slot(key, iterable):
                 depth=len(key),
                 key=db_key,
                 blob=blob_info,
+                codec=codec,
+                size=decoded_size,
+                digest=digest,
                 updated_at=now
             )
         else:
             assert isinstance(slot.blob, BlobInfo)
             slot.blob.delete()
             slot.blob = blob_info
+            slot.codec = codec
+            slot.size = decoded_size
+            slot.digest = digest
             slot.updated_at = now
         slot.put()
         delete(list_cache_key, namespace='list')
 
     run_in_transaction_options(create_transaction_options(xg=True), txn)
-    defer(push_to_dropbox, db_key, now)
+    mark_existing([cache_key], revised=True)
+    get_counter('put_slot.bytes').increment(decoded_size)
+    get_counter('put_slot.stored_bytes').increment(size)
+    if cache and size < CACHE_PARTS_LIMIT * CACHE_BYTES_LIMIT:
+        cache_slot(cache_key, ''.join(cache_buffer))
+    schedule_push(db_key)
 
 
-def get_dropbox_client():
-    client = get_client(redirect_on_fail=False)
+def get_dropbox_client(rest_client=RestClient):
+    client = get_client(redirect_on_fail=False, rest_client=rest_client)
     if client is None or not get_config('dropbox_path'):
         set_config('dropbox_access_token', None)
         set_config('dropbox_user_id', None)
-        set_config('dropbox_delta_cursor', None)
         set_config('dropbox_path', None)
+        reset_sync()
         return
     return client
 
@@ -241,7 +706,23 @@ def parse_rfc2822(rfc2822):
     return datetime.datetime.utcfromtimestamp(timestamp)
 
 
-def push_to_dropbox(slot_key, now):
+def schedule_push(slot_key):
+    """Schedule to push the slot to Dropbox.  Pushes of the same slot within
+    :const:`PUSH_WINDOW` seconds are coalesced into one, and it uploads
+    the latest revision of the slot at the moment.
+
+    :param slot_key: the key of the slot to push
+    :type slot_key: :class:`google.appengine.ext.db.Key`
+
+    """
+    name = 'push-' + hashlib.sha1(str(slot_key)).hexdigest()
+    defer_coalesced(name, PUSH_WINDOW, push_to_dropbox, slot_key)
+
+
+@instrument('push_to_dropbox', flush_after=True)
+def push_to_dropbox(slot_key, now=None):
+    # The now parameter is no more used, but remains for tasks that were
+    # deferred before pushes became coalesced.
     logger = logging.getLogger(__name__ + '.push_to_dropbox')
     client = get_dropbox_client()
     dropbox_path = get_config('dropbox_path')
@@ -250,10 +731,20 @@ def push_to_dropbox(slot_key, now):
     blob_size = None
     while blob_size is None:
         slot = Slot.get(slot_key)
+        if slot is None:
+            return
         dropbox_filename = dropbox_path + slot.key().name()
-        if slot.updated_at < now:
-            logger.info('%s was updated (at %s) after %s',
-                        dropbox_filename, slot.updated_at, now)
+        if not slot.is_dirty():
+            logger.info('%s is already synchronized (at %s)',
+                        dropbox_filename, slot.synced_at)
+            return
+        elif slot.digest is not None and slot.digest == slot.synced_digest:
+            logger.info('%s is the same to the rev %s; skip to push',
+                        dropbox_filename, slot.rev)
+            skipped_counter.increment()
+            skipped_bytes_counter.increment(slot.size or 0)
+            mark_synced(slot_key, Slot.blob.get_value_for_datastore(slot),
+                        slot.rev, slot.digest)
             return
         logger.info('pushing %s to dropbox', dropbox_filename)
         f = slot.blob.open()
@@ -263,6 +754,9 @@ def push_to_dropbox(slot_key, now):
             logger.info('failed to load %s from dirty buffer; retry...',
                         dropbox_filename)
             time.sleep(random.randrange(1, 5))
+    if slot.codec is not None:
+        f = SlotReader(f, slot.codec)
+        blob_size = slot.size
     if blob_size <= OUTGOING_BYTES_LIMIT:
         response = client.put_file(dropbox_filename, f,
                                    overwrite=True,
@@ -271,108 +765,646 @@ def push_to_dropbox(slot_key, now):
         uploader = client.get_chunked_uploader(f, blob_size)
         while uploader.offset < blob_size:
             uploader.upload_chunked(OUTGOING_BYTES_LIMIT)
-        uploader.finish(dropbox_filename, overwrite=True, parent_rev=slot.rev)
+        response = uploader.finish(dropbox_filename,
+                                   overwrite=True,
+                                   parent_rev=slot.rev)
     f.close()
-    rfc2822 = response['modified']
-    slot.synced_at = parse_rfc2822(rfc2822)
-    slot.rev = response['rev']
-    slot.put()
+    pushed_counter.increment()
+    pushed_bytes_counter.increment(blob_size)
+    mark_synced(slot_key, Slot.blob.get_value_for_datastore(slot),
+                response['rev'], slot.digest,
+                parse_rfc2822(response['modified']))
+
+
+def mark_synced(slot_key, pushed_blob_key, rev, digest, synced_at=None):
+    """Record that the slot content of the ``pushed_blob_key`` is
+    the ``rev`` on Dropbox.
 
+    :param slot_key: the key of the pushed slot
+    :type slot_key: :class:`google.appengine.ext.db.Key`
+    :param pushed_blob_key: the blob key of the pushed content
+    :type pushed_blob_key: :class:`google.appengine.ext.blobstore.BlobKey`
+    :param rev: the dropbox revision of the pushed content
+    :type rev: :class:`basestring`
+    :param digest: the digest of the pushed content
+    :type digest: :class:`str`
+    :param synced_at: the modification time on Dropbox
+    :type synced_at: :class:`datetime.datetime`
 
+    """
+    def txn():
+        slot = Slot.get(slot_key)
+        if slot is None:
+            return
+        slot.rev = rev
+        slot.synced_digest = digest
+        # If the slot was written again during the upload, the newer
+        # revision still has to be pushed by its own scheduled push.
+        if Slot.blob.get_value_for_datastore(slot) == pushed_blob_key:
+            slot.synced_at = max(synced_at or slot.updated_at,
+                                 slot.updated_at)
+        slot.put()
+    run_in_transaction(txn)
+
+
+class Download(object):
+    """The state of a Dropbox file being downloaded into blobstore.
+
+    :param path: the dropbox path of the file
+    :type path: :class:`basestring`
+    :param metadata: the dropbox metadata of the file
+    :type metadata: :class:`collections.Mapping`
+
+    """
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        self.filename = create(mime_type='text/xml')
+        self.offset = 0
+        self.size = 0
+        self.encoder = SlotEncoder(SLOT_CODEC)
+        self.hash = hashlib.sha1()
+        self.cache_buffer = [CACHE_PREFIXES[SLOT_CODEC]]
+
+    @property
+    def done(self):
+        return self.offset >= self.metadata['bytes']
+
+    @property
+    def window(self):
+        """(:class:`numbers.Integral`) The length of the next range
+        to fetch.
+
+        """
+        return min(self.metadata['bytes'] - self.offset, INCOMING_BYTES_LIMIT)
+
+    def write(self, src, length):
+        """Write the fetched range into the blobstore file.
+
+        :param src: the response of the fetched range
+        :type src: :class:`~.rest.ResponseReader`
+        :param length: the requested length of the range
+        :type length: :class:`numbers.Integral`
+        :raises IOError: when the response isn't exactly the requested
+                         range, e.g. the whole file or a truncated range
+
+        """
+        if src.status != 206:
+            src.close()
+            raise IOError('expected 206 Partial Content for {0!r} but got '
+                          '{1}'.format(self.path, src.status))
+        written = 0
+        with fopen(self.filename, 'ab') as dst:
+            while 1:
+                chunk = src.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                written += len(chunk)
+                self.hash.update(chunk)
+                self.write_encoded(dst, self.encoder.encode(chunk))
+            src.close()
+            if written != length:
+                raise IOError('expected {0} bytes of {1!r} from {2} but got '
+                              '{3}'.format(length, self.path, self.offset,
+                                           written))
+            self.offset += written
+            if self.done:
+                self.write_encoded(dst, self.encoder.flush())
+
+    def write_encoded(self, dst, chunk):
+        dst.write(chunk)
+        self.size += len(chunk)
+        if self.size < CACHE_BYTES_LIMIT:
+            self.cache_buffer.append(chunk)
+
+    def finish(self):
+        if not self.offset:
+            # Empty files are never fetched
+            with fopen(self.filename, 'ab') as dst:
+                self.write_encoded(dst, self.encoder.flush())
+        finalize(self.filename)
+        blob_info = BlobInfo.get(get_blob_key(self.filename))
+        if self.size < CACHE_BYTES_LIMIT:
+            cache_value = ''.join(self.cache_buffer)
+        else:
+            cache_value = None
+        self.cache_buffer = None
+        return blob_info, cache_value, self.hash.hexdigest()
+
+
+def download_files(client, files, concurrency=PULL_CONCURRENCY,
+                   bytes_budget=PULL_BYTES_BUDGET):
+    """Download the given Dropbox ``files`` into blobstore.  Up to
+    ``concurrency`` files are downloaded at a time, and each file is yielded
+    as soon as it's completely downloaded, so the order of results may
+    differ from the order of ``files``.
+
+    Files are fetched by ranges of :const:`INCOMING_BYTES_LIMIT` bytes,
+    and each range is written into blobstore before the next range of
+    the file is fetched.  Ranges being fetched at a time don't exceed
+    ``bytes_budget`` bytes in total unless a single range does, so that
+    memory usage is bounded regardless of file sizes.
+
+    :param client: the dropbox client made with
+                   :class:`~.rest.AsyncRestClient`
+    :type client: :class:`dropbox.client.DropboxClient`
+    :param files: pairs of dropbox path and metadata
+    :type files: :class:`collections.Iterable`
+    :param concurrency: the maximum number of files to download at a time
+    :type concurrency: :class:`numbers.Integral`
+    :param bytes_budget: the maximum bytes to fetch at a time
+    :type bytes_budget: :class:`numbers.Integral`
+    :returns: tuples of path, metadata, :class:`BlobInfo`, cache value
+              (:const:`None` if it's too large to cache) and the digest
+              of the content
+    :rtype: :class:`collections.Iterable`
+
+    """
+    files = iter(files)
+    running = {}
+    waiting = collections.deque()
+    done = []
+    state = {'downloads': 0, 'fetching_bytes': 0}
+
+    def enqueue(download):
+        if download.done:
+            done.append(download)
+        else:
+            waiting.append(download)
+
+    def start_downloads():
+        count = concurrency - state['downloads']
+        for path, metadata in itertools.islice(files, max(count, 0)):
+            state['downloads'] += 1
+            enqueue(Download(path, metadata))
+
+    def fetch_waiting():
+        while waiting:
+            length = waiting[0].window
+            if running and state['fetching_bytes'] + length > bytes_budget:
+                break
+            download = waiting.popleft()
+            future = client.get_file(download.path,
+                                     rev=download.metadata['rev'],
+                                     start=download.offset,
+                                     length=length)
+            running[future] = download, length
+            state['fetching_bytes'] += length
+
+    start_downloads()
+    fetch_waiting()
+    while running or done:
+        if not done:
+            future = wait_any(running)
+            download, length = running.pop(future)
+            state['fetching_bytes'] -= length
+            download.write(future.get_result(), length)
+            get_counter('pull.downloaded_bytes').increment(length)
+            enqueue(download)
+        while done:
+            download = done.pop()
+            state['downloads'] -= 1
+            blob_info, cache_value, digest = download.finish()
+            yield (download.path, download.metadata, blob_info, cache_value,
+                   digest)
+            start_downloads()
+        fetch_waiting()
+
+
+def apply_pulled_slots(changes):
+    """Apply pulled ``changes`` to the data store and memcache in bulk.
+    Slots are read and written in a cross-group transaction, so that
+    local changes committed meanwhile (see :func:`put_slot()`) aren't
+    overwritten without being noticed.  Hence ``changes`` can't span more
+    than 25 entity groups (see :const:`SYNC_APPLY_SIZE`).
+
+    :param changes: tuples of repository key, dropbox metadata
+                    (:const:`None` for deletion), :class:`BlobInfo`
+                    (:const:`None` for directories), cache value and
+                    the digest of the content
+    :type changes: :class:`collections.Sequence`
+    :returns: the latest modification time of the updated slots.
+              :const:`None` if nothing was updated
+    :rtype: :class:`datetime.datetime`
+
+    """
+    if not changes:
+        return
+    db_keys = [make_db_key(change[0]) for change in changes]
+    cache_keys = [make_cache_key(change[0]) for change in changes]
+    list_cache_keys = set(make_cache_key(change[0][:-1])
+                          for change in changes)
+
+    def txn():
+        slots = db_get(db_keys)
+        put_slots = []
+        delete_db_keys = []
+        garbage_blob_keys = []
+        deleted_cache_keys = []
+        last_modified = None
+        for change, db_key, cache_key, slot in zip(changes, db_keys,
+                                                   cache_keys, slots):
+            repo_key, metadata, blob_info, cache_value, digest = change
+            blob_key = slot and Slot.blob.get_value_for_datastore(slot)
+            if blob_key is not None:
+                # Local changes not pushed yet are overwritten as well
+                # (see Slot.is_dirty()).
+                garbage_blob_keys.append(blob_key)
+            if not metadata:
+                if slot is not None:
+                    delete_db_keys.append(db_key)
+                    deleted_cache_keys.append(cache_key)
+                continue
+            modified_at = parse_rfc2822(metadata['modified'])
+            if last_modified is None or modified_at > last_modified:
+                last_modified = modified_at
+            if slot is None:
+                slot = Slot(depth=len(repo_key), key=db_key)
+            slot.blob = blob_info
+            if blob_info is None:
+                slot.codec = slot.size = None
+            else:
+                slot.codec = SLOT_CODEC
+                slot.size = metadata['bytes']
+            slot.digest = slot.synced_digest = digest
+            slot.rev = metadata['rev']
+            slot.updated_at = modified_at
+            slot.synced_at = modified_at
+            put_slots.append(slot)
+        db_put(put_slots)
+        db_delete(delete_db_keys)
+        return last_modified, garbage_blob_keys, deleted_cache_keys
+
+    try:
+        last_modified, garbage_blob_keys, deleted_cache_keys = \
+            run_in_transaction_options(create_transaction_options(xg=True),
+                                       txn)
+    except Exception:
+        # Nothing refers to the blobs just uploaded, so they would leak.
+        blob_delete([change[2].key() for change in changes
+                     if change[2] is not None])
+        raise
+    blob_delete(garbage_blob_keys)
+    cache_values = {}
+    delete_cache_keys = []
+    for change, cache_key in zip(changes, cache_keys):
+        if change[3] is None:
+            delete_cache_keys.append(cache_key)
+        else:
+            cache_values[cache_key] = change[3]
+    delete_multi(delete_cache_keys, namespace='slot')
+    set_multi(cache_values, namespace='slot')
+    delete_multi(deleted_cache_keys, namespace='exists')
+    mark_existing((cache_key
+                   for change, cache_key in zip(changes, cache_keys)
+                   if change[1]),
+                  revised=True)
+    delete_multi(list(list_cache_keys), namespace='list')
+    invalidate_derived_caches(change[0] for change in changes)
+    return last_modified
+
+
+class SyncBatch(Model):
+    """A batch of Dropbox delta entries that a task applies.  The index of
+    the next entry to apply is checkpointed as :attr:`position`, so
+    an interrupted task resumes from where it stopped.  Batches are root
+    entities so that parallel batches don't contend for an entity group
+    to checkpoint; the ones not applied yet are tracked by
+    :attr:`SyncState.pending_batches` instead.  A batch is deleted when
+    its whole entries are applied.
+
+    """
+
+    #: (:class:`str`) The JSON-encoded list of path and metadata pairs.
+    entries = TextProperty(required=True)
+
+    #: (:class:`int`) The index of the next entry to apply.
+    position = IntegerProperty(required=True, default=0)
+
+    #: (:class:`str`) The key name of the batch to apply after this.
+    #: Batches of the same entity group of slots are chained not to
+    #: contend for it.
+    next_batch = StringProperty(indexed=False)
+
+    #: (:class:`datetime.datetime`) The latest modification time of
+    #: the applied entries.
+    last_modified = DateTimeProperty()
+
+
+class SyncState(Model):
+    """The state of the Dropbox sync.  There's only one entity of
+    :const:`SYNC_STATE_KEY`.  Delta pages are applied one by one: the next
+    page is fetched only after every batch of the previous page is applied,
+    so that changes of the same path in different pages are applied
+    in order.  Batches of the same page are applied in parallel, as
+    a path appears only once in a page.
+
+    """
+
+    #: (:class:`str`) The delta cursor of the next page to fetch.
+    cursor = TextProperty()
+
+    #: (:class:`int`) The number of syncs started so far.  It's a part of
+    #: key names of :class:`SyncBatch` so that a later sync from the same
+    #: cursor doesn't take batches of an earlier one.
+    generation = IntegerProperty(required=True, default=0, indexed=False)
+
+    #: (:class:`bool`) Whether it's the initial sync.
+    initial = BooleanProperty(required=True, default=False)
+
+    #: (:class:`bool`) Whether a delta page is being fetched and fanned out.
+    fetching = BooleanProperty(required=True, default=False)
+
+    #: (:class:`bool`) Whether the delta has to be fetched again after
+    #: the pending batches are applied.
+    has_more = BooleanProperty(required=True, default=False)
+
+    #: (:class:`collections.Sequence`) The key names of :class:`SyncBatch`
+    #: entities not applied yet.
+    pending_batches = StringListProperty(indexed=False)
+
+    #: (:class:`datetime.datetime`) The latest modification time of
+    #: the applied entries.
+    last_modified = DateTimeProperty(indexed=False)
+
+
+SYNC_STATE_KEY = Key.from_path('SyncState', 'dropbox')
+
+
+def get_sync_state():
+    state = SyncState.get(SYNC_STATE_KEY)
+    if state is None:
+        # The delta cursor used to be stored in the config.  Once the state
+        # is stored, even by reset_sync(), it's never read again.
+        state = SyncState(key=SYNC_STATE_KEY,
+                          cursor=get_config('dropbox_delta_cursor'))
+    return state
+
+
+def reset_sync():
+    """Forget the sync state and the batches not applied yet, so that
+    the next sync starts over from the beginning, e.g. of a newly linked
+    folder.  The generation is kept to make new batch names unique.
+
+    """
+    def txn():
+        state = get_sync_state()
+        SyncState(key=SYNC_STATE_KEY,
+                  generation=state.generation + 1).put()
+        return state.pending_batches
+    pending_batches = run_in_transaction(txn)
+    db_delete([Key.from_path('SyncBatch', key_name)
+               for key_name in pending_batches])
+
+
+def advance_sync(state):
+    """Store the ``state``, and fetch the next delta page if every batch
+    was applied.  It has to be called in a transaction.
+
+    :param state: the sync state to store
+    :type state: :class:`SyncState`
+    :returns: whether the sync is done
+    :rtype: :class:`bool`
+
+    """
+    done = not (state.fetching or state.pending_batches)
+    if done and state.has_more:
+        state.fetching = True
+        state.has_more = done = False
+        defer(fetch_delta_page, _transactional=True)
+    elif done:
+        state.initial = False
+    state.put()
+    return done
+
+
+@instrument('pull_from_dropbox', flush_after=True)
 def pull_from_dropbox():
+    """Start to sync changes from Dropbox.  The delta is fetched by
+    :func:`fetch_delta_page()` tasks.  If a sync is ongoing, the delta is
+    fetched again after it's done instead.
+
+    """
+    def txn():
+        state = get_sync_state()
+        if not (state.fetching or state.pending_batches):
+            state.initial = state.cursor is None
+            state.generation += 1
+        state.has_more = True
+        advance_sync(state)
+    run_in_transaction(txn)
+
+
+@instrument('fetch_delta_page', flush_after=True)
+def fetch_delta_page():
+    """Fetch a page of the Dropbox delta, and then fan it out to
+    :func:`apply_sync_batch` tasks by :const:`SYNC_BATCH_SIZE` entries.
+    The next page is fetched after they are applied (see :class:`SyncState`).
+
+    """
     client = get_dropbox_client()
     if client is None:
+        # The sync was reset by get_dropbox_client(); it's not advanced
+        # since nothing was synced.
+        def abort():
+            state = get_sync_state()
+            state.fetching = False
+            state.put()
+        run_in_transaction(abort)
         return
+    state = get_sync_state()
     path_prefix = get_config('dropbox_path')
-    cursor = get_config('dropbox_delta_cursor')
-    last_sync = get_config('dropbox_last_sync') or datetime.datetime(2000, 1, 1)
-    first = cursor is None
-    if first:
-        set_config('dropbox_sync_progress', (0, 1))
-    entries = []
-    while 1:
-        result = client.delta(cursor, path_prefix=path_prefix.rstrip('/'))
-        entries.extend(
-            (path, metadata)
-            for path, metadata in result['entries']
-        )
-        cursor = result['cursor']
-        set_config('dropbox_delta_cursor', cursor)
-        if not result['has_more']:
-            break
-    for i, (path, metadata) in enumerate(entries):
+    result = client.delta(state.cursor, path_prefix=path_prefix.rstrip('/'))
+    # Only the last entry of the same path in a page matters.
+    entries = result['entries']
+    indices = dict((path, i) for i, (path, _) in enumerate(entries))
+    entries = [entry for i, entry in enumerate(entries)
+               if indices[entry[0]] == i]
+    first_page = state.initial and state.cursor is None
+    if first_page:
+        set_config('dropbox_sync_progress', (0, len(entries)))
+    # Slots under the same top-level key share an entity group (see
+    # make_db_key()), so batches of each group are chained to be applied
+    # one by one, while different groups are applied in parallel.
+    groups = collections.defaultdict(list)
+    for entry in entries:
+        groups[entry[0][len(path_prefix):].split('/', 1)[0]].append(entry)
+    cursor_hash = hashlib.sha1(state.cursor or '').hexdigest()
+    for group, group_entries in sorted(groups.items()):
+        group_hash = hashlib.sha1(group.encode('utf-8')).hexdigest()[:8]
+        offsets = range(0, len(group_entries), SYNC_BATCH_SIZE)
+        next_batch = None
+        # The chain is made from its tail, so that every batch exists
+        # before the previous one is applied.
+        for offset in reversed(offsets):
+            key_name = '{0}-{1}-{2}-{3}'.format(state.generation, cursor_hash,
+                                                group_hash, offset)
+            batch_entries = group_entries[offset:offset + SYNC_BATCH_SIZE]
+            created = run_in_transaction_options(
+                create_transaction_options(xg=True),
+                create_sync_batch, key_name, json.dumps(batch_entries),
+                state.initial, next_batch, offset == 0
+            )
+            next_batch = key_name
+            if created and state.initial and not first_page:
+                size = len(batch_entries)
+                update_config(
+                    'dropbox_sync_progress',
+                    lambda progress: (progress[0], progress[1] + size)
+                )
+
+    def txn():
+        state = get_sync_state()
+        state.cursor = result['cursor']
+        state.fetching = False
+        state.has_more = state.has_more or result['has_more']
+        return advance_sync(state)
+    if run_in_transaction(txn):
+        finish_sync()
+
+
+def create_sync_batch(key_name, entries, first, next_batch=None,
+                      head=True):
+    """Create a :class:`SyncBatch` unless it was already created, and
+    defer :func:`apply_sync_batch()` for it if it's the ``head`` of
+    its chain.  It has to be called in a cross-group transaction.
+
+    :returns: whether the batch was created
+    :rtype: :class:`bool`
+
+    """
+    if SyncBatch.get_by_key_name(key_name) is not None:
+        return False
+    batch = SyncBatch(key_name=key_name, entries=entries,
+                      next_batch=next_batch)
+    batch.put()
+    state = get_sync_state()
+    state.pending_batches.append(key_name)
+    state.put()
+    if head:
+        defer(apply_sync_batch, batch.key(), first, _transactional=True)
+    return True
+
+
+def complete_sync_batch(batch, first=False):
+    """Delete the applied ``batch``, remove it from the pending batches,
+    and then defer the next batch of its chain.  It has to be called in
+    a cross-group transaction.
+
+    :returns: whether the sync is done
+    :rtype: :class:`bool`
+
+    """
+    batch.delete()
+    state = get_sync_state()
+    key_name = batch.key().name()
+    if key_name not in state.pending_batches:
+        # The batch belongs to a sync that was reset meanwhile.
+        return False
+    state.pending_batches.remove(key_name)
+    if batch.next_batch:
+        defer(apply_sync_batch, Key.from_path('SyncBatch', batch.next_batch),
+              first, _transactional=True)
+    if batch.last_modified is not None:
+        state.last_modified = max(batch.last_modified,
+                                  state.last_modified or batch.last_modified)
+    return advance_sync(state)
+
+
+@instrument('apply_sync_batch', flush_after=True)
+def apply_sync_batch(batch_key, first=False, concurrency=PULL_CONCURRENCY):
+    """Apply the entries of the given :class:`SyncBatch`.  It resumes from
+    the last checkpointed entry.
+
+    :param batch_key: the key of the batch to apply
+    :type batch_key: :class:`google.appengine.ext.db.Key`
+    :param first: whether it's the initial sync.  the sync progress is
+                  reported only for the initial sync
+    :type first: :class:`bool`
+    :param concurrency: the maximum number of files to download at a time
+    :type concurrency: :class:`numbers.Integral`
+
+    """
+    batch = SyncBatch.get(batch_key)
+    if batch is None:
+        return
+    client = get_dropbox_client(rest_client=AsyncRestClient)
+    if client is None:
+        return
+    path_prefix = get_config('dropbox_path')
+    entries = json.loads(batch.entries)
+    indices = dict((path, i) for i, (path, _) in enumerate(entries))
+    applied = set()
+    state = {'checkpointed': batch.position, 'completed': False,
+             'finished': False}
+    changes = []
+    change_indices = []
+
+    def apply_changes():
+        if state['completed']:
+            return
+        modified_at = apply_pulled_slots(changes)
+        if modified_at is not None:
+            batch.last_modified = max(modified_at,
+                                      batch.last_modified or modified_at)
+        applied.update(change_indices)
+        del changes[:], change_indices[:]
+        while batch.position in applied:
+            batch.position += 1
+        if batch.position >= len(entries):
+            state['completed'] = True
+            state['finished'] = run_in_transaction_options(
+                create_transaction_options(xg=True),
+                complete_sync_batch, batch, first
+            )
+        else:
+            batch.put()
+        if first:
+            size = batch.position - state['checkpointed']
+            update_config('dropbox_sync_progress',
+                          lambda progress: (progress[0] + size, progress[1]))
+        state['checkpointed'] = batch.position
+
+    def add_change(index, repo_key, metadata, blob_info=None,
+                   cache_value=None, digest=None):
+        changes.append((repo_key, metadata, blob_info, cache_value, digest))
+        change_indices.append(index)
+        if len(changes) >= SYNC_APPLY_SIZE:
+            apply_changes()
+
+    files = []
+    for i in xrange(batch.position, len(entries)):
+        path, metadata = entries[i]
         repo_key = path[len(path_prefix):].split('/')
-        cache_key = make_cache_key(repo_key)
-        list_cache_key = make_cache_key(repo_key[:-1])
         if not repo_key or any(not part for part in repo_key):
-            continue
-        db_key = make_db_key(repo_key)
-        if metadata:
-            rev = metadata['rev']
-            modified_at = parse_rfc2822(metadata['modified'])
-            last_sync = max(modified_at, last_sync)
-            if metadata['is_dir']:
-                blob_info = None
-                cache_value = 'D'
-            else:
-                filename = create(mime_type='text/xml')
-                cache_value = None
-                cache_buffer = ['F']
-                dst_size = 0
-                with fopen(filename, 'ab') as dst:
-                    for offset in xrange(0, metadata['bytes'],
-                                         INCOMING_BYTES_LIMIT):
-                        src = client.get_file(path,
-                                              rev=rev,
-                                              start=offset,
-                                              length=offset)
-                        while 1:
-                            chunk = src.read(10240)
-                            if chunk:
-                                dst_size += len(chunk)
-                                dst.write(chunk)
-                                if dst_size < CACHE_BYTES_LIMIT:
-                                    cache_buffer.append(chunk)
-                            else:
-                                break
-                    if dst_size < CACHE_BYTES_LIMIT:
-                        cache_value = ''.join(cache_buffer)
-                        del cache_buffer
-                finalize(filename)
-                blob_key = get_blob_key(filename)
-                blob_info = BlobInfo.get(blob_key)
-            def txn():
-                delete(cache_key, namespace='slot')
-                delete(list_cache_key, namespace='list')
-                slot = Slot.get(db_key)
-                if slot is None:
-                    slot = Slot(
-                        depth=len(repo_key),
-                        key=db_key,
-                        blob=blob_info,
-                        rev=rev,
-                        updated_at=modified_at,
-                        synced_at=modified_at
-                    )
-                else:
-                    if slot.blob is not None:
-                        slot.blob.delete()
-                    slot.blob = blob_info
-                    slot.rev = rev
-                    slot.updated_at = modified_at
-                    slot.synced_at = modified_at
-                slot.put()
-                if cache_value is not None:
-                    put(cache_key, cache_value, namespace='slot')
-                delete(list_cache_key, namespace='list')
-            run_in_transaction_options(create_transaction_options(xg=True),
-                                       txn)
+            applied.add(i)
+        elif metadata and not metadata['is_dir']:
+            # Files are downloaded altogether at once later
+            files.append((path, metadata))
         else:
-            slot = Slot.get(db_key)
-            if slot is not None:
-                slot.delete()
-                delete(cache_key, namespace='slot')
-        delete(list_cache_key, namespace='list')
-        if first:
-            set_config('dropbox_sync_progress', (i + 1, len(entries)))
+            add_change(i, repo_key, metadata, cache_value=metadata and 'D')
+    downloads = download_files(client, files, concurrency)
+    for path, metadata, blob_info, cache_value, digest in downloads:
+        repo_key = path[len(path_prefix):].split('/')
+        add_change(indices[path], repo_key, metadata, blob_info, cache_value,
+                   digest)
+    apply_changes()
+    if state['finished']:
+        finish_sync()
+
+
+def finish_sync():
+    """Record the last sync time when the sync is done (see
+    :func:`advance_sync()`).
+
+    """
+    state = SyncState.get(SYNC_STATE_KEY)
+    if state is None or state.fetching or state.pending_batches or \
+       state.has_more:
+        return
+    last_sync = get_config('dropbox_last_sync', fresh=True) or \
+        datetime.datetime(2000, 1, 1)
+    if state.last_modified is not None:
+        last_sync = max(state.last_modified, last_sync)
     set_config('dropbox_last_sync', last_sync)
@@ -15,17 +15,49 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import
 
-import io
 import json
+import logging
+import os
+import random
+import time
+import urlparse
 
 from dropbox.rest import (SDK_VERSION, ErrorResponse, RESTSocketError,
                           params_to_urlencoded, RESTClient)
-from google.appengine.api.urlfetch import fetch
+from google.appengine.api.apiproxy_stub_map import UserRPC
+from google.appengine.api.urlfetch import create_rpc, make_fetch_call
 from google.appengine.api.urlfetch_errors import (DownloadError,
                                                   SSLCertificateError)
 from werkzeug.http import HTTP_STATUS_CODES
 
-__all__ = 'RestClient', 'RestClientObject', 'RestErrorResponse'
+__all__ = ('IDEMPOTENT_POST_PATHS', 'INTERACTIVE_RETRY_TIME',
+           'MAX_RETRIES', 'MAX_RETRY_DELAY', 'RETRY_BASE_DELAY',
+           'AsyncRestClient', 'AsyncRestClientObject', 'RestClient',
+           'ResponseReader', 'RestClientObject', 'RestErrorResponse',
+           'RestFuture', 'get_retry_delay', 'is_idempotent', 'wait_any')
+
+
+#: (:class:`numbers.Integral`) The maximum number of retries of a request
+#: that failed with ``429 Too Many Requests`` or ``5xx`` status.
+MAX_RETRIES = 5
+
+#: (:class:`numbers.Real`) Seconds to wait before the first retry.
+#: It doubles for each retry.
+RETRY_BASE_DELAY = 0.5
+
+#: (:class:`numbers.Real`) The maximum seconds to wait before a retry.
+#: If the server asks to wait longer, the request is not retried.
+MAX_RETRY_DELAY = 30
+
+#: (:class:`numbers.Real`) The maximum seconds in total to wait for retries
+#: of a request made by a user-facing request, to finish in its deadline.
+#: Requests made by tasks and cron jobs can wait as long as
+#: :const:`MAX_RETRIES` allows.
+INTERACTIVE_RETRY_TIME = 10
+
+#: (:class:`collections.Set`) Paths of ``POST`` API calls that don't
+#: change anything, so that they're safe to retry on any failure.
+IDEMPOTENT_POST_PATHS = frozenset(['/1/delta'])
 
 
 class RestErrorResponse(ErrorResponse):
@@ -44,10 +76,190 @@ class RestErrorResponse(ErrorResponse):
             self.user_error_msg = None
 
 
+class ResponseReader(object):
+    """Read-only file-like object of a raw response body.  Unlike
+    :class:`io.BytesIO`, it doesn't make a copy of the whole body.
+
+    :param response: the urlfetch response
+    :type response: :class:`google.appengine.api.urlfetch._URLFetchResult`
+
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.offset = 0
+
+    def read(self, size=-1):
+        content = self.response.content
+        if size < 0:
+            end = len(content)
+        else:
+            end = min(self.offset + size, len(content))
+        chunk = content[self.offset:end]
+        self.offset = end
+        return chunk
+
+    @property
+    def status(self):
+        """(:class:`numbers.Integral`) The HTTP status code."""
+        return self.response.status_code
+
+    def getheader(self, name, default=None):
+        return self.response.headers.get(name, default)
+
+    def close(self):
+        # Drops the reference to the response body as soon as possible.
+        self.response.content = ''
+
+
+class RestFuture(object):
+    """The pending response of a request made through
+    :meth:`RestClientObject.request_async()`.  Call :meth:`get_result()`
+    to wait for the response.  Requests failed with ``429`` or ``5xx``
+    status are retried up to :const:`MAX_RETRIES` times (see also
+    :func:`get_retry_delay()`), and for :const:`INTERACTIVE_RETRY_TIME`
+    seconds at most unless it's made by a task.
+
+    :param client_object: the client object which made the request
+    :type client_object: :class:`RestClientObject`
+    :param method: the request method
+    :type method: :class:`str`
+    :param url: the requested url
+    :type url: :class:`basestring`
+    :param body: the request body
+    :type body: :class:`str`
+    :param headers: the request headers
+    :type headers: :class:`collections.Mapping`
+    :param rpc: the ongoing urlfetch rpc
+    :type rpc: :class:`google.appengine.api.apiproxy_stub_map.UserRPC`
+    :param raw_response: whether to return the raw response body
+    :type raw_response: :class:`bool`
+
+    """
+
+    def __init__(self, client_object, method, url, body, headers, rpc,
+                 raw_response):
+        self.client_object = client_object
+        self.method = method
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.rpc = rpc
+        self.raw_response = raw_response
+        self.retries = 0
+        self.idempotent = is_idempotent(method, url)
+        if os.environ.get('HTTP_X_APPENGINE_TASKNAME') or \
+           os.environ.get('HTTP_X_APPENGINE_CRON'):
+            self.retry_deadline = None
+        else:
+            self.retry_deadline = time.time() + INTERACTIVE_RETRY_TIME
+
+    def get_result(self):
+        logger = logging.getLogger(__name__ + '.RestFuture.get_result')
+        while 1:
+            try:
+                r = self.rpc.get_result()
+            except DownloadError as e:
+                raise RESTSocketError(self.url, e)
+            except SSLCertificateError as e:
+                raise RESTSocketError(self.url,
+                                      'SSL certificate error: ' + str(e))
+            if r.status_code in (200, 206):
+                break
+            delay = get_retry_delay(r, self.retries, self.idempotent)
+            if delay is None or self.retry_deadline is not None and \
+               time.time() + delay > self.retry_deadline:
+                raise RestErrorResponse(r)
+            self.retries += 1
+            logger.info('%s %s responded %d; retry #%d in %.1f seconds',
+                        self.method, self.url, r.status_code,
+                        self.retries, delay)
+            time.sleep(delay)
+            self.rpc = self.client_object.fetch_async(
+                self.method, self.url, self.body, self.headers
+            )
+        return self.client_object.process_response(r, self.raw_response)
+
+
+def is_idempotent(method, url):
+    """Whether the request is safe to retry even if the server might have
+    processed it.  Retrying e.g. ``files_put`` that was applied makes
+    Dropbox create a conflicted copy, since its ``parent_rev`` is outdated.
+
+    :param method: the request method
+    :type method: :class:`str`
+    :param url: the request url
+    :type url: :class:`basestring`
+    :rtype: :class:`bool`
+
+    """
+    method = method.upper()
+    if method in ('GET', 'HEAD'):
+        return True
+    return method == 'POST' and \
+        urlparse.urlparse(url).path in IDEMPOTENT_POST_PATHS
+
+
+def get_retry_delay(response, retries, idempotent=True):
+    """Get seconds to wait before retrying the request of the failed
+    ``response``.  It backs off exponentially from :const:`RETRY_BASE_DELAY`
+    with full jitter, but waits at least as long as ``Retry-After``
+    header asks.
+
+    :param response: the failed response
+    :type response: :class:`google.appengine.api.urlfetch._URLFetchResult`
+    :param retries: the number of retries made so far
+    :type retries: :class:`numbers.Integral`
+    :param idempotent: whether the request is idempotent
+                       (see :func:`is_idempotent()`).  non-idempotent
+                       requests are retried only if the server rejected
+                       them with ``429`` or ``503`` and ``Retry-After``
+    :type idempotent: :class:`bool`
+    :returns: seconds to wait.  :const:`None` if it shouldn't be retried
+    :rtype: :class:`numbers.Real`
+
+    """
+    status = response.status_code
+    if not (status == 429 or 500 <= status < 600) or retries >= MAX_RETRIES:
+        return
+    elif not (idempotent or status in (429, 503) and
+              'Retry-After' in response.headers):
+        return
+    delay = random.uniform(0, RETRY_BASE_DELAY * 2 ** retries)
+    try:
+        delay = max(delay, float(response.headers['Retry-After']))
+    except (KeyError, ValueError):
+        pass
+    if delay <= MAX_RETRY_DELAY:
+        return delay
+
+
+def wait_any(futures):
+    """Wait until any of the given ``futures`` is done.
+
+    :param futures: :class:`RestFuture` objects to wait
+    :type futures: :class:`collections.Iterable`
+    :returns: the done future
+    :rtype: :class:`RestFuture`
+
+    """
+    futures = dict((future.rpc, future) for future in futures)
+    rpc = UserRPC.wait_any(futures)
+    return futures[rpc]
+
+
 class RestClientObject(object):
 
     def request(self, method, url, post_params=None, body=None, headers=None,
                 raw_response=False):
+        return self.request_async(method, url,
+                                  post_params=post_params,
+                                  body=body,
+                                  headers=headers,
+                                  raw_response=raw_response).get_result()
+
+    def request_async(self, method, url, post_params=None, body=None,
+                      headers=None, raw_response=False):
         post_params = post_params or {}
         headers = headers or {}
         headers['User-Agent'] = 'OfficialDropboxPythonSDK/' + SDK_VERSION
@@ -71,24 +283,23 @@ class RestClientObject(object):
                 raise ValueError('headers should not contain newlines '
                                  '({0}: {1})'.format(key, value))
 
+        rpc = self.fetch_async(method, url, body, headers)
+        return RestFuture(self, method, url, body, headers, rpc, raw_response)
+
+    def fetch_async(self, method, url, body, headers):
+        rpc = create_rpc()
         try:
-            # Grab a connection from the pool to make the request.
-            # We return it to the pool when caller close() the response
-            r = fetch(url, body,
-                      method=method,
-                      headers=headers,
-                      validate_certificate=True)
+            make_fetch_call(rpc, url, body,
+                            method=method,
+                            headers=headers,
+                            validate_certificate=True)
         except DownloadError as e:
             raise RESTSocketError(url, e)
-        except SSLCertificateError as e:
-            raise RESTSocketError(url, 'SSL certificate error: ' + str(e))
-        if r.status_code not in (200, 206):
-            raise RestErrorResponse(r)
-        return self.process_response(r, raw_response)
+        return rpc
 
     def process_response(self, r, raw_response):
         if raw_response:
-            return io.BytesIO(r.content)
+            return ResponseReader(r)
         try:
             resp = json.loads(r.content)
         except ValueError:
@@ -116,6 +327,23 @@ class RestClientObject(object):
         )
 
 
+class AsyncRestClientObject(RestClientObject):
+    """Unlike :class:`RestClientObject`, its :meth:`request()` doesn't
+    block, but returns :class:`RestFuture` instead.  Every API call made
+    through it (e.g. :meth:`dropbox.client.DropboxClient.get_file()`)
+    returns a future as well.
+
+    """
+
+    def request(self, *args, **kwargs):
+        return self.request_async(*args, **kwargs)
+
+
 class RestClient(RESTClient):
 
     IMPL = RestClientObject()
+
+
+class AsyncRestClient(RESTClient):
+
+    IMPL = AsyncRestClientObject()
@@ -0,0 +1,109 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+
+import collections
+import uuid
+
+from google.appengine.api import memcache
+
+__all__ = ('Sidebar', 'SidebarItem', 'get_sidebar', 'invalidate_sidebar',
+           'is_subscription_list_key')
+
+
+#: The precomputed model of the subscription sidebar.
+#: Its ``subscriptions`` are :class:`SidebarItem`\ s sorted by label.
+Sidebar = collections.namedtuple(
+    'Sidebar',
+    'version title initialized subscriptions'
+)
+
+#: A subscription listed in the sidebar.
+SidebarItem = collections.namedtuple('SidebarItem', 'feed_id label icon_uri')
+
+
+VERSION_KEY = 'version'
+SIDEBAR_KEY = 'sidebar'
+
+
+def is_subscription_list_key(key):
+    """Whether the repository ``key`` is of a subscription list document
+    of any session.
+
+    :param key: the repository key
+    :type key: :class:`collections.Sequence`
+    :rtype: :class:`bool`
+
+    """
+    return len(key) == 1 and key[0].startswith('subscriptions.')
+
+
+def get_sidebar(stage):
+    """Get the sidebar model of the subscription list.  It's cached along
+    with the version stamp, so that the cached one is used until the version
+    is changed by :func:`invalidate_sidebar()`.
+
+    :param stage: the stage to read the subscription list from
+                  if the cached one is outdated
+    :type stage: :class:`libearth.stage.Stage`
+    :returns: the sidebar model
+    :rtype: :class:`Sidebar`
+
+    """
+    cached = memcache.get_multi([VERSION_KEY, SIDEBAR_KEY],
+                                namespace='sidebar')
+    version = cached.get(VERSION_KEY)
+    sidebar = cached.get(SIDEBAR_KEY)
+    if version is not None and sidebar is not None and \
+       sidebar.version == version:
+        return sidebar
+    if version is None:
+        version = uuid.uuid4().hex
+        if not memcache.add(VERSION_KEY, version, namespace='sidebar'):
+            # Another request made the version first; if it's invalidated
+            # in the meantime the built sidebar is just not cached.
+            version = memcache.get(VERSION_KEY, namespace='sidebar')
+    # The version has to be read before the subscription list, so that
+    # the sidebar built from the outdated list never gets the new version.
+    with stage:
+        subscriptions = stage.subscriptions
+        if subscriptions is None:
+            title = None
+            initialized = False
+            items = []
+        else:
+            title = subscriptions.title
+            initialized = bool(subscriptions.head and subscriptions.owner)
+            items = [
+                SidebarItem(feed_id=sub.feed_id,
+                            label=sub.label,
+                            icon_uri=sub.icon_uri)
+                for sub in subscriptions.recursive_subscriptions
+            ]
+    items.sort(key=lambda item: item.label)
+    sidebar = Sidebar(version=version, title=title, initialized=initialized,
+                      subscriptions=items)
+    if version is not None:
+        memcache.set(SIDEBAR_KEY, sidebar, namespace='sidebar')
+    return sidebar
+
+
+def invalidate_sidebar():
+    """Make the cached sidebar outdated.  It has to be called after
+    the subscription list document is changed.
+
+    """
+    memcache.delete(VERSION_KEY, namespace='sidebar')
@@ -15,13 +15,123 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import
 
+import threading
+
 from google.appengine.api.app_identity import get_application_id
+from google.appengine.ext.db import get as db_get
+from libearth.schema import read, write
 from libearth.session import Session
-from libearth.stage import Stage
+from libearth.stage import Stage, compile_format_to_pattern
+
+from .cache import LocalCache, get_multi
+from .repository import DataStoreRepository, make_cache_key, make_db_key
+
+__all__ = ('MERGED_CACHE_BYTES_LIMIT', 'CachedStage', 'get_session',
+           'get_stage', 'merged_cache')
+
+
+#: (:class:`numbers.Integral`) The byte budget of merged documents that
+#: the process keeps.
+MERGED_CACHE_BYTES_LIMIT = 16 * 1000 * 1000  # 16MB
+
+#: (:class:`~.cache.LocalCache`) Merged documents that stages of
+#: the process share.  See also :class:`CachedStage`.
+merged_cache = LocalCache(MERGED_CACHE_BYTES_LIMIT)
+merged_cache_lock = threading.Lock()
+
+
+class CachedStage(Stage):
+    """Stage that keeps merged documents in the process, and reuses them
+    across requests as long as revisions of the per-session documents they
+    were merged from remain the same.  Revisions of the documents are
+    checked by their revision markers in memcache (see
+    :func:`~.repository.mark_existing()`), and only documents of which
+    markers are missing are checked by their slots'
+    :attr:`~.repository.Slot.rev` and :attr:`~.repository.Slot.updated_at`
+    instead.
 
-from .repository import DataStoreRepository
+    Merged documents are kept serialized, so that modifying a returned
+    document doesn't affect the cache.  Only documents merged from more
+    than one document are cached, since merging loads them entirely
+    anyway, while a single document is returned as lazily parsed as
+    the stage reads it.  Stages themselves aren't shared across requests,
+    since libearth holds a stage's lock during repository calls, but their
+    caches are.
 
-__all__ = 'get_session', 'get_stage'
+    :param session: the session of the stage
+    :type session: :class:`libearth.session.Session`
+    :param repository: the repository of the stage
+    :type repository: :class:`libearth.repository.Repository`
+    :param cache: the cache of merged documents.  :data:`merged_cache`
+                  by default
+    :type cache: :class:`~.cache.LocalCache`
+    :param cache_lock: the lock of the ``cache``
+    :type cache_lock: :class:`threading.Lock`
+
+    """
+
+    def __init__(self, session, repository, cache=None, cache_lock=None):
+        super(CachedStage, self).__init__(session, repository)
+        if cache is None:
+            cache, cache_lock = merged_cache, merged_cache_lock
+        self.merged_cache = cache
+        self.merged_cache_lock = cache_lock or threading.Lock()
+
+    def get_revision_signature(self, subkeys):
+        """Get the signature of revisions of the documents to merge.
+
+        :param subkeys: the keys of the documents
+        :type subkeys: :class:`collections.Sequence`
+        :returns: the signature that changes whenever any of the documents
+                  is updated
+        :rtype: :class:`tuple`
+
+        """
+        markers = get_multi([make_cache_key(k) for k in subkeys],
+                            namespace='exists')
+        revisions = dict((tuple(k), markers.get(make_cache_key(k)))
+                         for k in subkeys)
+        # Bare presence markers (True) don't tell revisions.
+        unknown = [k for k, marker in revisions.iteritems()
+                   if not isinstance(marker, basestring)]
+        if unknown:
+            slots = db_get([make_db_key(k) for k in unknown])
+            revisions.update((k, slot and (slot.rev, slot.updated_at))
+                             for k, slot in zip(unknown, slots))
+        return tuple(sorted(revisions.iteritems()))
+
+    def read_merged_document(self, document_type, key_spec, key):
+        transaction = self.get_current_transaction()
+        if transaction.dictionary:
+            # Documents staged in the ongoing transaction aren't revisioned.
+            return super(CachedStage, self).read_merged_document(
+                document_type, key_spec, key
+            )
+        complete_size = len(key)
+        pattern = compile_format_to_pattern(key_spec[complete_size])
+        subkeys = sorted(key + [subkey] + key_spec[complete_size + 1:]
+                         for subkey in transaction.list(key)
+                         if pattern.match(subkey))
+        if len(subkeys) < 2:
+            return super(CachedStage, self).read_merged_document(
+                document_type, key_spec, key
+            )
+        signature = self.get_revision_signature(subkeys)
+        cache_key = document_type.__name__, tuple(key)
+        with self.merged_cache_lock:
+            cached = self.merged_cache.get(cache_key)
+        if cached is not None and cached[0] == signature:
+            return read(document_type, [cached[1]])
+        document = super(CachedStage, self).read_merged_document(
+            document_type, key_spec, key
+        )
+        # Reading can stamp and write documents; such results aren't cached
+        # since their signature becomes outdated by the writes.
+        if document is not None and not transaction.dictionary:
+            data = ''.join(write(document, as_bytes=True))
+            with self.merged_cache_lock:
+                self.merged_cache.set(cache_key, (signature, data))
+        return document
 
 
 def get_session():
@@ -30,6 +140,11 @@ def get_session():
 
 
 def get_stage():
-    repository = DataStoreRepository()
-    session = get_session()
-    return Stage(session, repository)
+    """Get a new stage of the application.  Merged documents it caches are
+    shared by requests the process serves (see :class:`CachedStage`).
+
+    :returns: the stage
+    :rtype: :class:`CachedStage`
+
+    """
+    return CachedStage(get_session(), DataStoreRepository())
@@ -0,0 +1,135 @@
+# ergae --- Earth Reader on Google App Engine
+# Copyright (C) 2014 Hong Minhee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
+
+import hashlib
+
+from google.appengine.ext.db import (IntegerProperty, Key, Model,
+                                     get as db_get, run_in_transaction)
+
+from .cache import delete, get_boxed_multi
+from .index import get_entry_key
+from .journal import get_read_marks
+from .stage import get_stage
+from .util import defer_coalesced
+
+__all__ = ('RECOUNT_WINDOW', 'UnreadCount', 'get_unread_counts',
+           'recount_unread', 'schedule_unread_recount', 'update_unread_count')
+
+
+#: (:class:`numbers.Integral`) Seconds to collect changes of a feed
+#: before its unread entries are counted again.
+RECOUNT_WINDOW = 60
+
+
+class UnreadCount(Model):
+    """The number of unread entries of a feed.  Its key name is the feed id.
+    Counts are root entities so that feeds are counted in parallel without
+    contending for an entity group, and the total is summed up from them
+    (see :func:`get_unread_counts()`).
+
+    """
+
+    count = IntegerProperty(required=True, default=0)
+
+
+def get_unread_counts(feed_ids):
+    """Get the numbers of unread entries of the given feeds, and
+    their total.
+
+    :param feed_ids: the ids of feeds to count
+    :type feed_ids: :class:`collections.Iterable`
+    :returns: a pair of the total count and the mapping of feed ids to
+              their unread counts.  feeds not counted yet are missing
+    :rtype: :class:`tuple`
+
+    """
+    def load(feed_ids):
+        unread_counts = db_get([Key.from_path('UnreadCount', feed_id)
+                                for feed_id in feed_ids])
+        return dict((feed_id, unread_count and unread_count.count)
+                    for feed_id, unread_count in zip(feed_ids, unread_counts))
+    cached = get_boxed_multi(list(feed_ids), load, namespace='unread_counts')
+    counts = dict((feed_id, count) for feed_id, count in cached.iteritems()
+                  if count is not None)
+    return sum(counts.itervalues()), counts
+
+
+def update_unread_count(feed_id, function):
+    """Atomically replace the unread count of the feed with
+    ``function(count)``, in the same way as :func:`~.config.update_config()`.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+    :param function: the function that takes the current count
+                     (:const:`None` if not counted yet) and returns a new
+                     count (:const:`None` to forget the feed)
+    :type function: :class:`collections.Callable`
+    :returns: the updated count
+    :rtype: :class:`numbers.Integral`
+
+    """
+    def txn():
+        key = Key.from_path('UnreadCount', feed_id)
+        unread_count = db_get(key)
+        count = function(unread_count and unread_count.count)
+        if count is None:
+            if unread_count is not None:
+                unread_count.delete()
+        else:
+            count = max(count, 0)
+            UnreadCount(key=key, count=count).put()
+        return count
+    count = run_in_transaction(txn)
+    # Puts of concurrent updates could land out of order, so the cached
+    # count is just dropped, to be filled again from the data store
+    # (see get_unread_counts()).
+    delete(feed_id, namespace='unread_counts')
+    return count
+
+
+def schedule_unread_recount(feed_id):
+    """Schedule to count unread entries of the feed again.  Changes of
+    a feed in :const:`RECOUNT_WINDOW` are counted at once.
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+
+    """
+    name = 'recount-unread-' + hashlib.sha1(feed_id).hexdigest()
+    defer_coalesced(name, RECOUNT_WINDOW, recount_unread, feed_id)
+
+
+def recount_unread(feed_id):
+    """Count unread entries of the feed, excluding entries journaled
+    as read (see :mod:`ergae.journal`).
+
+    :param feed_id: the feed id
+    :type feed_id: :class:`basestring`
+
+    """
+    stage = get_stage()
+    with stage:
+        try:
+            feed = stage.feeds[feed_id]
+        except LookupError:
+            count = None
+        else:
+            read_marks = get_read_marks(feed_id)
+            count = sum(1 for entry in feed.entries
+                        if not entry.read and
+                        get_entry_key(entry) not in read_marks)
+    update_unread_count(feed_id, lambda _: count)
@@ -14,8 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import re
+import time
 
-__all__ = 'MethodRewriteMiddleware',
+from google.appengine.api.taskqueue import (TaskAlreadyExistsError,
+                                            TombstonedTaskError)
+from google.appengine.ext.deferred import defer
+
+__all__ = 'MethodRewriteMiddleware', 'defer_coalesced'
 
 
 class MethodRewriteMiddleware(object):
@@ -68,3 +73,34 @@ class MethodRewriteMiddleware(object):
                 environ = dict(environ)
                 environ['REQUEST_METHOD'] = match.group(1)
         return self.app(environ, start_response)
+
+
+def defer_coalesced(name, window, function, *args, **kwargs):
+    """Defer the ``function`` to run at the end of the current time window.
+    Calls of the same ``name`` within a window are coalesced into
+    the only task, so the ``function`` should take the latest state
+    by itself rather than rely on ``args``.
+
+    :param name: the name that identifies the work to coalesce.
+                 it can consist of only alphanumerics, hyphens and
+                 underscores
+    :type name: :class:`str`
+    :param window: the length of time windows in seconds
+    :type window: :class:`numbers.Real`
+    :param function: the function to defer
+    :type function: :class:`collections.Callable`
+    :returns: whether a new task was enqueued.  :const:`False` if
+              there's already the task of the same window
+    :rtype: :class:`bool`
+
+    """
+    now = time.time()
+    window_number = int(now // window)
+    countdown = (window_number + 1) * window - now
+    task_name = '{0}-{1}-{2}'.format(name, int(window), window_number)
+    try:
+        defer(function, _name=task_name, _countdown=countdown,
+              *args, **kwargs)
+    except (TaskAlreadyExistsError, TombstonedTaskError):
+        return False
+    return True